@@ -0,0 +1,215 @@
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from datetime import datetime, timedelta
+import logging
+import threading
+import time
+import zlib
+import simplejson
+from model import Report, ReportBucket, MAP_FIELDS
+import recent
+
+## reports are rolled up into one bucket per hour of their date
+BUCKET = timedelta(hours=1)
+## an hour is closed this long after it ends, so reports still waiting in
+## the write-behind buffer or the pull queue are stored before its bucket
+SETTLE = timedelta(minutes=30)
+## longest window served, older buckets are dropped from memory
+MAX_DAYS = 14
+
+def bucket_start(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+def hot_start(now=None):
+    ## start of the oldest hour that is not closed, read from the index
+    return bucket_start((now or datetime.now()) - SETTLE)
+
+def bucket_name(title, start):
+    return '%s:%s' % (title, start.strftime('%Y%m%d%H'))
+
+def query_range(title, start, end=None):
+    ## reports dated start <= date < end, projected like main.query_reports
+    reports = Report.all(projection=('date',) + MAP_FIELDS)
+    reports.filter('title', title)
+    reports.filter('date >=', start)
+    if end is not None:
+        reports.filter('date <', end)
+    reports.order('-date')
+    return reports
+
+def pack(entries):
+    return db.Blob(zlib.compress(simplejson.dumps(entries, separators=(',', ':'))))
+
+def unpack(blob):
+    return [tuple(e) for e in simplejson.loads(zlib.decompress(blob))]
+
+class BucketCache():
+    """Closed hours of reports, built once and then only read.
+
+    A window is the closed buckets it covers plus one index query for the
+    hot part, the hours since hot_start(). A closed bucket is looked for
+    in memory, then memcache, then its ReportBucket row, and only built
+    (one range query for all the missing ones) if none has it.
+
+    Reports dated into a closed hour (bulk import, a late flush) delete
+    its bucket and bump the title's epoch, which makes every instance
+    drop the buckets it holds in memory.
+    """
+
+    def __init__(self, max_days=MAX_DAYS):
+        self.max_age = timedelta(days=max_days + 1)
+        self.buckets = {}
+        self.epochs = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.loaded = 0
+        self.built = 0
+        self.invalidated = 0
+
+    def epoch(self, title):
+        key = 'bucket_epoch:%s' % title
+        epoch = memcache.get(key)
+        if epoch is None:
+            memcache.add(key, int(time.time() * 1000))
+            epoch = memcache.get(key)
+        return epoch
+
+    def window(self, title, startDate, now=None):
+        ## (id, date, lat, lng, water) of reports after startDate, newest first
+        now = now or datetime.now()
+        hot = hot_start(now)
+        starts = []
+        start = bucket_start(startDate)
+        while start < hot:
+            starts.append(start)
+            start += BUCKET
+        closed = self.closed(title, starts, now)
+        entries = [recent.to_entry(r) for r in query_range(title, hot)]
+        for start in reversed(starts):
+            entries.extend(closed[start])
+        since = recent.timestamp(startDate)
+        while entries and entries[-1][1] <= since:
+            entries.pop()
+        return entries
+
+    def closed(self, title, starts, now):
+        ## {start: entries} for closed hours
+        epoch = self.epoch(title)
+        self.lock.acquire()
+        try:
+            if self.epochs.get(title) != epoch:
+                for key in [k for k in self.buckets if k[0] == title]:
+                    del self.buckets[key]
+                self.epochs[title] = epoch
+        finally:
+            self.lock.release()
+
+        found = {}
+        missing = []
+        for start in starts:
+            entries = self.buckets.get((title, start))
+            if entries is None:
+                missing.append(start)
+            else:
+                found[start] = entries
+        self.hits += len(found)
+        if not missing:
+            return found
+
+        loaded = {}
+        names = dict([(bucket_name(title, s), s) for s in missing])
+        for name, blob in memcache.get_multi(names.keys(), key_prefix='bucket:').items():
+            loaded[names[name]] = unpack(blob)
+        rest = [name for name in names if names[name] not in loaded]
+        if rest:
+            blobs = {}
+            for row in ReportBucket.get_by_key_name(rest):
+                if row is not None:
+                    loaded[row.start] = unpack(row.points)
+                    blobs[row.key().name()] = row.points
+            if blobs:
+                memcache.set_multi(blobs, key_prefix='bucket:')
+        self.loaded += len(loaded)
+        missing = [s for s in missing if s not in loaded]
+        if missing:
+            loaded.update(self.build(title, missing, epoch))
+        self.keep(title, loaded, epoch, now)
+        found.update(loaded)
+        return found
+
+    def build(self, title, starts, epoch):
+        ## one range query over the missing hours, split by hour
+        built = dict([(s, []) for s in starts])
+        for r in query_range(title, starts[0], starts[-1] + BUCKET):
+            entries = built.get(bucket_start(r.date))
+            if entries is not None:
+                entries.append(recent.to_entry(r))
+        self.built += len(built)
+        if self.epoch(title) != epoch:
+            ## a late report came in meanwhile, serve these but keep nothing
+            return built
+        rows = []
+        blobs = {}
+        for start, entries in built.items():
+            name = bucket_name(title, start)
+            blobs[name] = pack(entries)
+            rows.append(ReportBucket(key_name=name, title=title, start=start,
+                                     count=len(entries), points=blobs[name]))
+        try:
+            db.put(rows)
+        except db.Error, e:
+            ## built again by whoever misses them next
+            logging.warning('%d report buckets not stored: %s', len(rows), e)
+            return built
+        memcache.set_multi(blobs, key_prefix='bucket:')
+        if self.epoch(title) != epoch:
+            ## written() bumped the epoch between the check above and the
+            ## put, and may have deleted its bucket before ours landed. a
+            ## bump after this check is followed by its own delete
+            memcache.delete_multi(blobs.keys(), key_prefix='bucket:')
+            try:
+                db.delete([row.key() for row in rows])
+            except db.Error, e:
+                logging.warning('stale report buckets %s not dropped: %s',
+                                blobs.keys(), e)
+        return built
+
+    def keep(self, title, loaded, epoch, now):
+        oldest = now - self.max_age
+        self.lock.acquire()
+        try:
+            if self.epochs.get(title) != epoch:
+                return
+            for key in [k for k in self.buckets if k[1] < oldest]:
+                del self.buckets[key]
+            for start, entries in loaded.items():
+                self.buckets[(title, start)] = entries
+        finally:
+            self.lock.release()
+
+    def written(self, title, reports, now=None):
+        ## after a put: drop the buckets of closed hours reports were dated in
+        hot = hot_start(now)
+        starts = set([bucket_start(r.date) for r in reports if r.date < hot])
+        if not starts:
+            return
+        names = [bucket_name(title, s) for s in starts]
+        ## the reports are stored, so nothing here may raise: the caller
+        ## would put (and count) them again
+        memcache.incr('bucket_epoch:%s' % title)
+        memcache.delete_multi(names, key_prefix='bucket:')
+        try:
+            db.delete([db.Key.from_path('ReportBucket', name) for name in names])
+        except db.Error, e:
+            logging.warning('report buckets %s not dropped: %s', names, e)
+        self.invalidated += len(names)
+
+    def stats(self):
+        return { 'buckets': len(self.buckets),
+                'hits': self.hits,
+                'loaded': self.loaded,
+                'built': self.built,
+                'invalidated': self.invalidated
+                }
+
+bucket_cache = BucketCache()
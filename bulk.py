@@ -0,0 +1,117 @@
+from google.appengine.ext import db
+from datetime import datetime
+import logging
+import simplejson
+from model import Report
+from ingest import clean_report, build_report, put_reports
+
+## reports per datastore fetch / put
+PAGE_SIZE = 500
+## rows per export response, follow X-Next-Cursor for the rest
+EXPORT_LIMIT = 20000
+## import errors echoed back, the rest are only counted
+MAX_ERRORS = 100
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+def format_date(dt):
+    return dt.strftime(DATE_FORMAT) + '.%06d' % dt.microsecond
+
+def parse_date(value):
+    seconds, dot, micro = value.partition('.')
+    date = datetime.strptime(seconds, DATE_FORMAT)
+    if micro:
+        date = date.replace(microsecond=int(micro.ljust(6, '0')[:6]))
+    return date
+
+def to_row(r):
+    return { 'id': r.key().id(),
+            'title': r.title,
+            'lat': r.lat,
+            'lng': r.lng,
+            'water': r.water,
+            'road': r.road,
+            'name': r.name,
+            'text': r.text,
+            'area': r.area,
+            'city': r.city,
+            'date': r.date and format_date(r.date)
+            }
+
+class ReportExport():
+    """NDJSON lines for a title's reports, in key order.
+
+    Iterating fetches PAGE_SIZE reports at a time with a datastore cursor,
+    so only one page is held at once. After iterating, cursor is where a
+    follow-up export should start, or None once everything was sent.
+    """
+
+    def __init__(self, title, cursor=None, limit=EXPORT_LIMIT):
+        self.title = title
+        self.cursor = cursor
+        self.limit = limit
+        self.count = 0
+
+    def __iter__(self):
+        while self.count < self.limit:
+            query = Report.all().filter('title', self.title).order('__key__')
+            if self.cursor:
+                query.with_cursor(self.cursor)
+            page = query.fetch(min(PAGE_SIZE, self.limit - self.count))
+            for r in page:
+                yield simplejson.dumps(to_row(r)) + '\n'
+            self.count += len(page)
+            if len(page) < PAGE_SIZE and self.count < self.limit:
+                self.cursor = None
+                return
+            self.cursor = query.cursor()
+
+def import_lines(title, lines):
+    """Store NDJSON report rows, PAGE_SIZE per db.put().
+
+    lines can be a file, only one batch is held at once. Rows go through
+    the same checks as the report form; 'date' (as exported) is kept when
+    present. Returns counts and the first MAX_ERRORS bad lines. If a put
+    fails, 'stopped_at' is the line to post again from: rows before it are
+    stored or rejected, rows after its batch are not read. db.put is not
+    atomic, so some rows of the failed batch may be stored already.
+    """
+    result = { 'imported': 0, 'rejected': 0, 'errors': [] }
+    batch = []
+    first = None
+    for number, line in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = simplejson.loads(line)
+            date = row.get('date') and parse_date(row['date']) or None
+            report = build_report(title, clean_report(row), date)
+        except (ValueError, AttributeError, TypeError, db.BadValueError), e:
+            result['rejected'] += 1
+            if len(result['errors']) < MAX_ERRORS:
+                result['errors'].append({ 'line': number + 1, 'error': str(e) })
+            continue
+        if first is None:
+            first = number + 1
+        batch.append(report)
+        if len(batch) >= PAGE_SIZE:
+            if not store(batch, first, result):
+                return result
+            batch = []
+            first = None
+    if batch:
+        store(batch, first, result)
+    return result
+
+def store(batch, first, result):
+    ## put one import batch, first is the line of its first row
+    try:
+        put_reports(batch)
+    except db.Error, e:
+        logging.warning('import stopped at line %d: %s', first, e)
+        result['stopped_at'] = first
+        result['error'] = str(e)
+        return False
+    result['imported'] += len(batch)
+    return True
@@ -0,0 +1,123 @@
+import threading
+import geo
+from localsearch import MercatorProjection, numpy
+
+## zooms 0 .. MAX_ZOOM-1 are served as clusters, closer zooms get raw points
+MAX_ZOOM = 13
+## side of a cluster cell in screen pixels
+CELL_PIXELS = 64
+
+projection = MercatorProjection(MAX_ZOOM)
+
+def bin_points(lats, lngs, waters, xs, ys):
+    """Bin points into CELL_PIXELS squares given their pixel coordinates.
+
+    Returns one dict per non-empty cell with the centroid, the number of
+    points, the mean water level (as 'water', so the client colours it
+    like a single report) and the max water level.
+    """
+    if numpy is not None:
+        return bin_points_numpy(lats, lngs, waters, xs, ys)
+    cells = {}
+    for lat, lng, water, x, y in zip(lats, lngs, waters, xs, ys):
+        key = (int(x) // CELL_PIXELS, int(y) // CELL_PIXELS)
+        c = cells.get(key)
+        if c is None:
+            cells[key] = [1, lat, lng, water, water]
+        else:
+            c[0] += 1
+            c[1] += lat
+            c[2] += lng
+            c[3] += water
+            c[4] = max(c[4], water)
+    return [{ 'lat': lat / n,
+             'lng': lng / n,
+             'count': n,
+             'water': int(round(total / float(n))),
+             'max': top
+             } for n, lat, lng, total, top in cells.values()]
+
+def bin_points_numpy(lats, lngs, waters, xs, ys):
+    if not len(lats):
+        return []
+    waters = numpy.asarray(waters)
+    cols = (numpy.asarray(xs) // CELL_PIXELS).astype(numpy.int64)
+    rows = (numpy.asarray(ys) // CELL_PIXELS).astype(numpy.int64)
+    keys, cell = numpy.unique(cols * (1 << 32) + rows, return_inverse=True)
+    counts = numpy.bincount(cell)
+    lat_sums = numpy.bincount(cell, weights=lats)
+    lng_sums = numpy.bincount(cell, weights=lngs)
+    water_sums = numpy.bincount(cell, weights=waters)
+    tops = numpy.zeros(len(keys), dtype=waters.dtype)
+    numpy.maximum.at(tops, cell, waters)
+    return [{ 'lat': lat / n,
+             'lng': lng / n,
+             'count': n,
+             'water': int(round(total / n)),
+             'max': top
+             } for n, lat, lng, total, top in zip(counts.tolist(),
+                    lat_sums.tolist(), lng_sums.tolist(),
+                    water_sums.tolist(), tops.tolist())]
+
+def columns(points):
+    ## [(lat, lng, water), ...] -> [lat, ...], [lng, ...], [water, ...]
+    lats, lngs, waters = [], [], []
+    for lat, lng, water in points:
+        lats.append(lat)
+        lngs.append(lng)
+        waters.append(water)
+    return lats, lngs, waters
+
+def cluster_points(points, zoom):
+    lats, lngs, waters = columns(points)
+    xs, ys = projection.FromLatLngsToPixels(lats, lngs, zoom)
+    return bin_points(lats, lngs, waters, xs, ys)
+
+class ClusterSet():
+    ## clusters for every clustered zoom level of one version of the data
+
+    def __init__(self, version, points):
+        lats, lngs, waters = columns(points)
+        pixels = projection.FromLatLngsToPixelsAllZooms(lats, lngs)
+        self.version = version
+        self.points = (lats, lngs, waters)
+        self.levels = []
+        self.indexes = []
+        for xs, ys in pixels:
+            level = bin_points(lats, lngs, waters, xs, ys)
+            self.levels.append(level)
+            self.indexes.append(geo.GeohashIndex([(c['lat'], c['lng'], c)
+                                                  for c in level]))
+
+    def get(self, zoom, bbox=None):
+        if bbox is None:
+            return self.levels[zoom]
+        return self.indexes[zoom].query(bbox)
+
+class VersionCache():
+    """Latest object per report title for the current data version.
+
+    Whatever is cached (ClusterSet, TileSet ...) is built once, the first
+    time a request sees a new version, every other request is a lookup.
+    """
+
+    def __init__(self):
+        self.current = {}
+        self.lock = threading.Lock()
+
+    def get(self, title, version, build):
+        ## build(version) makes the object, it must keep .version
+        value = self.current.get(title)
+        if value is not None and value.version == version:
+            return value
+        self.lock.acquire()
+        try:
+            value = self.current.get(title)
+            if value is None or value.version != version:
+                value = build(version)
+                self.current[title] = value
+            return value
+        finally:
+            self.lock.release()
+
+cluster_cache = VersionCache()
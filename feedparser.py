@@ -1,36 +1,146 @@
+# -*- coding: utf-8 -*-
+import os
+import re
 import urllib
+import urllib2
+import hashlib
+import logging
+import threading
 from xml.dom import minidom
+from xml.etree import cElementTree
 import simplejson as json
+import calendar
+from google.appengine.ext import db
+import geo
+from geocode import geocoder
+from model import Feed, FeedState, get_generation
+
+FEED_FILE = 'feed.xml'
+FEED_URL = 'http://fms2.drr.go.th/feed'
+## name the hourly ingest (task.py) stores the feed under
+FEED_NAME = 'fms'
+## Feed rows read per datastore fetch
+ROW_PAGE = 500
+
+## <item> child tags we keep, in the order Item reads them
+FIELDS = ('id', 'title', 'description', 'canpass', 'date', 'lat', 'lon')
 
 def getText(nodelist):
     rc = []
     for node in nodelist:
         if node.nodeType == node.TEXT_NODE:
             rc.append(node.data)
-    return ''.join(rc)      
-
-class Item():
-
-    def __init__(self,obj):
-        self.obj = obj
-        self.title = self.extractData('title')
-        self.desc = self.extractData('desc') 
-        self.canpass = self.extractData('canpass')  
-        self.date = self.extractData('date') 
-        self.lat = self.extractData('lat') 
-        self.lng = self.extractData('lon') 
-    
+    return ''.join(rc)
+
+def extractData(node, field):
+    try:
+        return getText(node.getElementsByTagName(field)[0].childNodes)
+    except:
+        return ''
+
+def node_fields(node):
+    ## minidom path: one subtree walk per field
+    return dict([(f, extractData(node, f)) for f in FIELDS])
+
+def iter_fields(source):
+    """Yield a {field: text} dict for every <item> in source, in one pass.
+
+    source is a file name or file object. Each <item> is dropped from the
+    tree as soon as it has been read, so memory stays flat however long
+    the feed is.
+    """
+    stack = []
+    fields = None
+    for event, elem in cElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            if elem.tag == 'item':
+                fields = {}
+            continue
+        stack.pop()
+        if elem.tag == 'item':
+            yield fields
+            fields = None
+            ## drop the finished item (and anything before it) from its parent
+            if stack:
+                stack[-1].clear()
+        elif fields is not None and elem.tag in FIELDS and elem.tag not in fields:
+            fields[elem.tag] = elem.text or ''
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+## water level in a title, e.g. u'... สูง 80 ซม. (ผ่านได้)' (80 cm high)
+NUMBER = ur'(\d+(?:\.\d+)?)'
+UNITS = { u'เซนติเมตร': 1,
+         u'ซ.ม.': 1,
+         u'ซม.': 1,
+         u'ซม': 1,
+         u'cm': 1,
+         u'เมตร': 100,
+         u'ม.': 100,
+         u'm': 100
+         }
+UNIT = u'(%s)' % u'|'.join([re.escape(u) for u in
+                            sorted(UNITS, key=len, reverse=True)])
+## N [- / ถึง (to) M] [unit], a range counts as its top
+RANGE = NUMBER + ur'(?:\s*(?:-|–|ถึง)\s*' + NUMBER + u')?'
+## a unit must not run on into a word, e.g. ม. (metre) in ม.ค. (January)
+NOT_WORD = ur'(?![a-z\u0e01-\u0e4e])'
+## after สูง (high) [ประมาณ (about)] the unit may be left out, cm then
+WATER_RE = re.compile(ur'สูง\s*(?:ประมาณ\s*)?' + RANGE + ur'\s*' + UNIT +
+                      u'?' + NOT_WORD, re.U | re.I)
+## anywhere else a number needs its unit
+BARE_WATER_RE = re.compile(ur'(?<![\d.])' + RANGE + ur'\s*' + UNIT +
+                           NOT_WORD, re.U | re.I)
+
+## the map's 0-8 scale is 15cm a step
+WATER_STEP = 15
+WATER_MAX = 8
+
+def water_cm(title):
+    ## level in the title in cm, or None. with re.U \d also matches Thai
+    ## digits, and float() reads them from a unicode string
+    m = WATER_RE.search(title) or BARE_WATER_RE.search(title)
+    if m is None:
+        return None
+    low, high, unit = m.groups()
+    return float(high or low) * UNITS.get((unit or u'cm').lower(), 1)
+
+def water_bucket(cm):
+    if cm is None:
+        return 0
+    return min(int(cm / WATER_STEP), WATER_MAX)
+
+class Item(object):
+    """One feed <item>: the water level is parsed once, lat/lng are floats
+    (None when the feed has no usable position) and no DOM node is kept.
+
+    level is the water level in cm from the title (None if it has none),
+    water the map's 0-8 bucket of it.
+    """
+    __slots__ = ('id', 'title', 'desc', 'canpass', 'date', 'lat', 'lng',
+                 'geocoded', 'level', 'water')
+
+    def __init__(self,fields):
+        self.id = fields.get('id', '')
+        self.title = fields.get('title', '')
+        self.desc = fields.get('description', '')
+        self.canpass = fields.get('canpass', '')
+        self.date = fields.get('date', '')
+        self.lat = to_float(fields.get('lat'))
+        self.lng = to_float(fields.get('lon'))
+        ## set by geocode.Geocoder when it fills in lat/lng
+        self.geocoded = None
+        self.level = water_cm(self.title)
+        self.water = water_bucket(self.level)
+
     def road(self):
-        if self.canpass == 't':
-            return True
-        else:
-            return False
+        return self.canpass == 't'
 
-    def extractData(self,field):
-        try:
-            return getText(self.obj.getElementsByTagName(field)[0].childNodes)
-        except:
-            return ''
     def text(self):
         try:
             text =  '%s\n%s'%(self.title,self.desc)
@@ -38,45 +148,209 @@ class Item():
         except:
             return ''
 
-    def water(self):
-        try:
-            ## feed return level in cm unit // i have to change it to [0-8]
-            text_array = self.title.split(' ')         
-            level = float(text_array[4])
-            my_level = level/15
-            if my_level > 8:
-                return 8
-            return int(my_level)
-
-
-        except:
-            return 0
     def to_dict(self):
         return { 'lat': self.lat,
                 'lng': self.lng,
                 #'text': self.text(),
                 #'road': self.road(),
-                'water': self.water()
+                'water': self.water
                 }
 
     def __repr__(self):
-        return json.dumps(self.to_dict)
-    
+        return json.dumps(self.to_dict())
+
 class FeedFMSParser():
-    def __init__(self):
+    def __init__(self, source=FEED_FILE, streaming=True, geocoder=None):
         #self.feed_url = "http://fms2.drr.go.th/feed"
         #self.dom = minidom.parse(urllib.urlopen(self.feed_url))
-        document = open('feed.xml').read()
-        self.dom = minidom.parseString(document)
-    
+        self.source = source
+        self.streaming = streaming
+        ## fills in items without lat/lng, see geocode.py
+        self.geocoder = geocoder
+        self.dom = None
+        if not streaming:
+            document = open(source).read()
+            self.dom = minidom.parseString(document)
+
+    def items(self):
+        if self.streaming:
+            fields_list = iter_fields(self.source)
+        else:
+            fields_list = (node_fields(i) for i in self.dom.getElementsByTagName('item'))
+        for fields in fields_list:
+            item = Item(fields)
+            if self.geocoder is not None:
+                self.geocoder.locate(item)
+            yield item
+
     def list_items(self):
         items = []
-        for i in self.dom.getElementsByTagName('item'):
-            item = Item(i)
-            if item.water == 0 or item.lat == "" or item.lng == "":
+        for item in self.items():
+            ## only items without a position are left out. the old check
+            ## compared the water method with 0, which never held, so
+            ## items under 15cm (and closed roads at 0cm) stay on the map
+            if item.lat is None or item.lng is None:
                 pass
             else:
                 items.append(item.to_dict())
 
         return items
 
+
+class FileFetcher():
+    ## local stand-in for the gov feed, used by the dev server
+    def __init__(self, path=FEED_FILE):
+        self.name = path
+        self.path = path
+
+    def fetch(self):
+        f = open(self.path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+class UrlFetcher():
+    def __init__(self, url=FEED_URL):
+        self.name = url
+        self.url = url
+
+    def fetch(self):
+        f = urllib2.urlopen(self.url)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+def generation_name(name=FEED_NAME):
+    ## the ingest bumps this generation (model.py) whenever the feed changed
+    return 'feed:%s' % name
+
+def feed_rows(name=FEED_NAME):
+    ## to_dict() of the ingested Feed rows that have a position
+    query = Feed.all()
+    ## key names are 'name:id'
+    query.filter('__key__ >', db.Key.from_path('Feed', name + ':'))
+    query.filter('__key__ <', db.Key.from_path('Feed', name + ';'))
+    items = []
+    while True:
+        page = query.fetch(ROW_PAGE)
+        for row in page:
+            if row.lat is not None and row.lng is not None:
+                items.append(row.to_dict())
+        if len(page) < ROW_PAGE:
+            return items
+        query.with_cursor(query.cursor())
+
+class FeedSnapshot():
+    """The map items of one version of the feed.
+
+    modified is when that version was stored (epoch seconds), generation
+    the feed generation it was loaded under.
+    """
+
+    def __init__(self, generation, version, items, modified):
+        self.generation = generation
+        self.version = version
+        self.items = items
+        self.modified = modified
+        points = []
+        for i in items:
+            points.append((i['lat'], i['lng'], i))
+        self.points = points
+        self.index = geo.GeohashIndex(points)
+
+    def in_bbox(self, bbox):
+        return self.index.query(bbox)
+
+class FeedCache():
+    """Process-wide cache of the feed's map items.
+
+    The items are the Feed rows the hourly ingest (task.py) stored. A
+    request only pays for one memcache get of the feed generation, which
+    the ingest bumps whenever the feed changed. On a new generation the
+    FeedState row tells whether the content really changed, and only then
+    are the rows read. The new snapshot is built aside and swapped in with
+    one assignment, so readers always see either the old or the new one.
+
+    Until a first ingest has stored the feed (e.g. the dev server) the
+    items are parsed from the bundled file instead.
+    """
+
+    def __init__(self, source=FEED_FILE, geocoder=None, name=FEED_NAME):
+        self.source = source
+        self.geocoder = geocoder
+        self.name = name
+        self.current = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+
+    def get(self):
+        generation = get_generation(generation_name(self.name))
+        snapshot = self.current
+        if snapshot is not None and snapshot.generation == generation:
+            self.hits += 1
+            return snapshot
+        self.lock.acquire()
+        try:
+            snapshot = self.current
+            if snapshot is not None and snapshot.generation == generation:
+                self.hits += 1
+                return snapshot
+            self.misses += 1
+            try:
+                snapshot = self.load(generation, snapshot)
+            except db.Error, e:
+                if snapshot is None:
+                    raise
+                ## keep serving the old items, try again next request
+                logging.warning('feed %s not reloaded: %s', self.name, e)
+                return snapshot
+            self.current = snapshot
+            return snapshot
+        finally:
+            self.lock.release()
+
+    def load(self, generation, snapshot):
+        state = FeedState.get_by_key_name(self.name)
+        if state is None or not state.version:
+            return self.load_file(generation, snapshot)
+        modified = calendar.timegm(state.updated.timetuple())
+        if snapshot is not None and snapshot.version == state.version:
+            ## generation moved (or memcache lost it), content did not
+            items = snapshot.items
+        else:
+            items = tuple(feed_rows(self.name))
+            self.rebuilds += 1
+            logging.info('feed %s reloaded: version %s, %d items',
+                         self.name, state.version, len(items))
+        return FeedSnapshot(generation, state.version, items, modified)
+
+    def load_file(self, generation, snapshot):
+        f = open(self.source, 'rb')
+        try:
+            version = hashlib.md5(f.read()).hexdigest()
+        finally:
+            f.close()
+        modified = os.stat(self.source).st_mtime
+        if snapshot is not None and snapshot.version == version:
+            items = snapshot.items
+        else:
+            items = tuple(FeedFMSParser(self.source, geocoder=self.geocoder).list_items())
+            self.rebuilds += 1
+            logging.info('feed %s parsed: version %s, %d items',
+                         self.source, version, len(items))
+        return FeedSnapshot(generation, version, items, modified)
+
+    def stats(self):
+        snapshot = self.current
+        return { 'hits': self.hits,
+                'misses': self.misses,
+                'rebuilds': self.rebuilds,
+                'version': snapshot and snapshot.version,
+                'items': snapshot and len(snapshot.items) or 0
+                }
+
+feed_cache = FeedCache(geocoder=geocoder)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+## local place table for geocode.py and rollups.py: the 77 provinces,
+## positioned at their provincial town (lat, lng)
+import math
+
+
+PROVINCES = { u'กรุงเทพมหานคร': (13.7563, 100.5018),
+             u'กระบี่': (8.0863, 98.9063),
+             u'กาญจนบุรี': (14.0228, 99.5328),
+             u'กาฬสินธุ์': (16.4322, 103.5061),
+             u'กำแพงเพชร': (16.4828, 99.5227),
+             u'ขอนแก่น': (16.4419, 102.8360),
+             u'จันทบุรี': (12.6114, 102.1039),
+             u'ฉะเชิงเทรา': (13.6904, 101.0779),
+             u'ชลบุรี': (13.3611, 100.9847),
+             u'ชัยนาท': (15.1852, 100.1251),
+             u'ชัยภูมิ': (15.8068, 102.0315),
+             u'ชุมพร': (10.4930, 99.1800),
+             u'เชียงราย': (19.9105, 99.8406),
+             u'เชียงใหม่': (18.7883, 98.9853),
+             u'ตรัง': (7.5563, 99.6114),
+             u'ตราด': (12.2428, 102.5175),
+             u'ตาก': (16.8840, 99.1259),
+             u'นครนายก': (14.2069, 101.2131),
+             u'นครปฐม': (13.8199, 100.0622),
+             u'นครพนม': (17.3920, 104.7695),
+             u'นครราชสีมา': (14.9799, 102.0978),
+             u'นครศรีธรรมราช': (8.4304, 99.9631),
+             u'นครสวรรค์': (15.7030, 100.1370),
+             u'นนทบุรี': (13.8621, 100.5144),
+             u'นราธิวาส': (6.4255, 101.8253),
+             u'น่าน': (18.7756, 100.7730),
+             u'บึงกาฬ': (18.3609, 103.6464),
+             u'บุรีรัมย์': (14.9930, 103.1029),
+             u'ปทุมธานี': (14.0208, 100.5250),
+             u'ประจวบคีรีขันธ์': (11.8124, 99.7973),
+             u'ปราจีนบุรี': (14.0509, 101.3717),
+             u'ปัตตานี': (6.8696, 101.2501),
+             u'พระนครศรีอยุธยา': (14.3532, 100.5689),
+             u'พะเยา': (19.1664, 99.9019),
+             u'พังงา': (8.4501, 98.5255),
+             u'พัทลุง': (7.6167, 100.0740),
+             u'พิจิตร': (16.4429, 100.3487),
+             u'พิษณุโลก': (16.8211, 100.2659),
+             u'เพชรบุรี': (13.1119, 99.9397),
+             u'เพชรบูรณ์': (16.4190, 101.1606),
+             u'แพร่': (18.1446, 100.1403),
+             u'ภูเก็ต': (7.8804, 98.3923),
+             u'มหาสารคาม': (16.1851, 103.3007),
+             u'มุกดาหาร': (16.5420, 104.7235),
+             u'แม่ฮ่องสอน': (19.3020, 97.9654),
+             u'ยโสธร': (15.7926, 104.1453),
+             u'ยะลา': (6.5411, 101.2804),
+             u'ร้อยเอ็ด': (16.0538, 103.6520),
+             u'ระนอง': (9.9529, 98.6085),
+             u'ระยอง': (12.6814, 101.2816),
+             u'ราชบุรี': (13.5283, 99.8134),
+             u'ลพบุรี': (14.7995, 100.6534),
+             u'ลำปาง': (18.2888, 99.4909),
+             u'ลำพูน': (18.5745, 99.0087),
+             u'เลย': (17.4860, 101.7223),
+             u'ศรีสะเกษ': (15.1186, 104.3220),
+             u'สกลนคร': (17.1545, 104.1348),
+             u'สงขลา': (7.1898, 100.5954),
+             u'สตูล': (6.6238, 100.0674),
+             u'สมุทรปราการ': (13.5991, 100.5998),
+             u'สมุทรสงคราม': (13.4098, 100.0023),
+             u'สมุทรสาคร': (13.5475, 100.2744),
+             u'สระแก้ว': (13.8240, 102.0646),
+             u'สระบุรี': (14.5289, 100.9101),
+             u'สิงห์บุรี': (14.8936, 100.3967),
+             u'สุโขทัย': (17.0056, 99.8264),
+             u'สุพรรณบุรี': (14.4745, 100.1177),
+             u'สุราษฎร์ธานี': (9.1382, 99.3217),
+             u'สุรินทร์': (14.8818, 103.4936),
+             u'หนองคาย': (17.8783, 102.7420),
+             u'หนองบัวลำภู': (17.2218, 102.4260),
+             u'อ่างทอง': (14.5896, 100.4551),
+             u'อำนาจเจริญ': (15.8657, 104.6258),
+             u'อุดรธานี': (17.4138, 102.7872),
+             u'อุตรดิตถ์': (17.6200, 100.0993),
+             u'อุทัยธานี': (15.3835, 100.0246),
+             u'อุบลราชธานี': (15.2287, 104.8564)
+             }
+
+## other spellings seen in place strings
+ALIASES = { u'กรุงเทพ': u'กรุงเทพมหานคร',
+           u'กรุงเทพฯ': u'กรุงเทพมหานคร',
+           u'กทม': u'กรุงเทพมหานคร',
+           u'กทม.': u'กรุงเทพมหานคร',
+           u'อยุธยา': u'พระนครศรีอยุธยา'
+           }
+
+## province prefix of rural road codes, e.g. สพ.6098 is in สุพรรณบุรี
+ROAD_CODES = { u'กพ': u'กำแพงเพชร',
+              u'กส': u'กาฬสินธุ์',
+              u'ขก': u'ขอนแก่น',
+              u'ฉช': u'ฉะเชิงเทรา',
+              u'ชน': u'ชัยนาท',
+              u'ชบ': u'ชลบุรี',
+              u'ตก': u'ตาก',
+              u'ตร': u'ตราด',
+              u'นค': u'หนองคาย',
+              u'นฐ': u'นครปฐม',
+              u'นน': u'น่าน',
+              u'นบ': u'นนทบุรี',
+              u'นภ': u'หนองบัวลำภู',
+              u'นม': u'นครราชสีมา',
+              u'นย': u'นครนายก',
+              u'นว': u'นครสวรรค์',
+              u'บร': u'บุรีรัมย์',
+              u'ปจ': u'ปราจีนบุรี',
+              u'ปท': u'ปทุมธานี',
+              u'พจ': u'พิจิตร',
+              u'พช': u'เพชรบูรณ์',
+              u'พล': u'พิษณุโลก',
+              u'ภก': u'ภูเก็ต',
+              u'มค': u'มหาสารคาม',
+              u'มส': u'แม่ฮ่องสอน',
+              u'มห': u'มุกดาหาร',
+              u'รบ': u'ราชบุรี',
+              u'รย': u'ระยอง',
+              u'รอ': u'ร้อยเอ็ด',
+              u'ลบ': u'ลพบุรี',
+              u'ลย': u'เลย',
+              u'ศก': u'ศรีสะเกษ',
+              u'สก': u'สระแก้ว',
+              u'สต': u'สตูล',
+              u'สท': u'สุโขทัย',
+              u'สน': u'สกลนคร',
+              u'สบ': u'สระบุรี',
+              u'สป': u'สมุทรปราการ',
+              u'สพ': u'สุพรรณบุรี',
+              u'สร': u'สุรินทร์',
+              u'สห': u'สิงห์บุรี',
+              u'อจ': u'อำนาจเจริญ',
+              u'อด': u'อุดรธานี',
+              u'อต': u'อุตรดิตถ์',
+              u'อท': u'อ่างทอง',
+              u'อน': u'อุทัยธานี',
+              u'อบ': u'อุบลราชธานี',
+              u'อย': u'พระนครศรีอยุธยา'
+              }
+
+def province(name):
+    ## canonical province name, or None
+    name = ALIASES.get(name, name)
+    if name in PROVINCES:
+        return name
+    return None
+
+## reports further than this from every provincial town get no province
+MAX_PROVINCE_KM = 150
+
+def distance_km(lat1, lng1, lat2, lng2):
+    ## equirectangular, good enough at province scale
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371 * math.hypot(x, y)
+
+def nearest_province(lat, lng, max_km=MAX_PROVINCE_KM):
+    ## province whose town is closest to lat/lng, or None
+    best, best_km = None, max_km
+    for name, (p_lat, p_lng) in PROVINCES.items():
+        km = distance_km(lat, lng, p_lat, p_lng)
+        if km <= best_km:
+            best, best_km = name, km
+    return best
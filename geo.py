@@ -0,0 +1,148 @@
+import math
+from bisect import bisect_left
+
+## geohash length stored on reports, 8 chars is about 38m x 19m
+GEOCELL_RES = 8
+## max cells per viewport query, each one is a datastore sub-query (IN <= 30)
+MAX_CELLS = 12
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def encode(lat, lng, precision=GEOCELL_RES):
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    chars = []
+    ch = 0
+    bits = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            if lng >= mid:
+                ch = ch * 2 + 1
+                lng_lo = mid
+            else:
+                ch = ch * 2
+                lng_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                ch = ch * 2 + 1
+                lat_lo = mid
+            else:
+                ch = ch * 2
+                lat_hi = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[ch])
+            ch = 0
+            bits = 0
+    return ''.join(chars)
+
+def cells(lat, lng, max_res=GEOCELL_RES):
+    ## every prefix of the point's geohash, stored as a list property
+    full = encode(lat, lng, max_res)
+    return [full[:i] for i in range(1, max_res + 1)]
+
+def cell_size(precision):
+    ## (height, width) in degrees of a cell with this many chars
+    lng_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+def parse_bbox(value):
+    """Parse 'sw_lat,sw_lng,ne_lat,ne_lng' (LatLngBounds.toUrlValue()).
+
+    Raises ValueError on anything that is not a sane box. sw_lng may be
+    greater than ne_lng when the box crosses the antimeridian.
+    """
+    parts = [float(p) for p in value.split(',')]
+    if len(parts) != 4:
+        raise ValueError('bbox needs 4 numbers: %r' % value)
+    sw_lat, sw_lng, ne_lat, ne_lng = parts
+    if not -90 <= sw_lat <= ne_lat <= 90:
+        raise ValueError('bad bbox latitudes: %r' % value)
+    if not (-180 <= sw_lng <= 180 and -180 <= ne_lng <= 180):
+        raise ValueError('bad bbox longitudes: %r' % value)
+    return sw_lat, sw_lng, ne_lat, ne_lng
+
+def in_bbox(lat, lng, bbox):
+    sw_lat, sw_lng, ne_lat, ne_lng = bbox
+    if not sw_lat <= lat <= ne_lat:
+        return False
+    if sw_lng <= ne_lng:
+        return sw_lng <= lng <= ne_lng
+    return lng >= sw_lng or lng <= ne_lng
+
+def _lng_spans(bbox):
+    sw_lat, sw_lng, ne_lat, ne_lng = bbox
+    if sw_lng <= ne_lng:
+        return [(sw_lng, ne_lng)]
+    return [(sw_lng, 180.0), (-180.0, ne_lng)]
+
+def _index_range(lo, hi, origin, size, count):
+    first = int(math.floor((lo - origin) / size))
+    last = int(math.floor((hi - origin) / size))
+    return max(first, 0), min(last, count - 1)
+
+def bbox_cells(bbox, max_res=GEOCELL_RES, max_cells=MAX_CELLS):
+    """Geohash prefixes that together cover bbox.
+
+    Picks the finest resolution at which the cover has at most max_cells
+    cells, so a viewport query costs a handful of prefix lookups whatever
+    its size. Returns None when even 1-char cells are too many (the box
+    is most of the world) and the caller should not filter at all.
+    """
+    sw_lat, ne_lat = bbox[0], bbox[2]
+    spans = _lng_spans(bbox)
+    for precision in range(max_res, 0, -1):
+        height, width = cell_size(precision)
+        rows = int(round(180.0 / height))
+        cols = int(round(360.0 / width))
+        j0, j1 = _index_range(sw_lat, ne_lat, -90.0, height, rows)
+        ranges = [_index_range(lo, hi, -180.0, width, cols) for lo, hi in spans]
+        count = (j1 - j0 + 1) * sum([i1 - i0 + 1 for i0, i1 in ranges])
+        if count > max_cells:
+            continue
+        result = []
+        for j in range(j0, j1 + 1):
+            lat = -90.0 + (j + 0.5) * height
+            for i0, i1 in ranges:
+                for i in range(i0, i1 + 1):
+                    result.append(encode(lat, -180.0 + (i + 0.5) * width, precision))
+        return result
+    return None
+
+class GeohashIndex():
+    """In-memory points sorted by geohash.
+
+    A bbox query is one bisect per covering cell, so it costs
+    O(cells * log n + hits) instead of a scan over every point.
+    """
+
+    def __init__(self, points, precision=GEOCELL_RES, max_cells=64):
+        ## points: iterable of (lat, lng, value)
+        entries = [(encode(lat, lng, precision), lat, lng, value)
+                   for lat, lng, value in points]
+        entries.sort(key=lambda e: e[0])
+        self.precision = precision
+        self.max_cells = max_cells
+        self.hashes = [e[0] for e in entries]
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def query(self, bbox):
+        prefixes = bbox_cells(bbox, self.precision, self.max_cells)
+        if prefixes is None:
+            candidates = self.entries
+        else:
+            candidates = []
+            for prefix in prefixes:
+                lo = bisect_left(self.hashes, prefix)
+                hi = bisect_left(self.hashes, prefix + '~', lo)
+                candidates.extend(self.entries[lo:hi])
+        return [value for h, lat, lng, value in candidates
+                if in_bbox(lat, lng, bbox)]
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+from google.appengine.ext import db
+import logging
+import re
+import threading
+import gazetteer
+from model import Place
+
+## จ.สุพรรณบุรี (province Suphan Buri)
+PROVINCE_RE = re.compile(ur'(?:^|\s)(?:จ\.|จังหวัด)\s*([^\s\d,()]+)', re.U)
+## ทางหลวง สพ.6098 (highway, road code)
+ROAD_RE = re.compile(ur'(?:^|\s)([^\s\d.,()]{2})\.\s*\d+', re.U)
+
+def normalize(text):
+    return u' '.join(text.split())
+
+def place_keys(title, desc):
+    ## place strings to try for an item, best first
+    keys = []
+    for text in (title, desc):
+        for name in PROVINCE_RE.findall(text or u''):
+            keys.append(u'province:%s' % normalize(name))
+    for text in (title, desc):
+        for code in ROAD_RE.findall(text or u''):
+            if code in gazetteer.ROAD_CODES:
+                keys.append(u'road:%s' % code)
+    return keys
+
+def resolve(key):
+    ## gazetteer position for a place key, or None
+    kind, name = key.split(u':', 1)
+    if kind == u'road':
+        name = gazetteer.ROAD_CODES.get(name)
+    else:
+        name = gazetteer.province(name)
+    return gazetteer.PROVINCES.get(name)
+
+class Geocoder():
+    """Positions for feed items that have none, at province level.
+
+    Every place string is resolved once: the answer (or the miss) is kept
+    in memory and in a Place row, so other instances and later parses
+    read it back instead of resolving again, and a corrected Place row
+    wins over the gazetteer.
+    """
+
+    def __init__(self):
+        self.places = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.loaded = 0
+        self.resolved = 0
+
+    def lookup(self, key):
+        if key in self.places:
+            self.hits += 1
+            return self.places[key]
+        self.lock.acquire()
+        try:
+            if key in self.places:
+                return self.places[key]
+            position = None
+            try:
+                place = Place.get_by_key_name(key)
+                if place is None:
+                    position = resolve(key)
+                    place = Place(key_name=key)
+                    if position is not None:
+                        place.lat, place.lng = position
+                    place.put()
+                    self.resolved += 1
+                else:
+                    if place.lat is not None and place.lng is not None:
+                        position = (place.lat, place.lng)
+                    self.loaded += 1
+            except db.Error, e:
+                ## serve the gazetteer, the row is written next time
+                logging.warning('place %s not cached: %s', key, e)
+                return resolve(key)
+            self.places[key] = position
+            return position
+        finally:
+            self.lock.release()
+
+    def locate(self, item):
+        ## fill in item.lat/lng (and item.geocoded) if it has no position
+        if item.lat is not None and item.lng is not None:
+            return item
+        for key in place_keys(item.title, item.desc):
+            position = self.lookup(key)
+            if position is not None:
+                item.lat, item.lng = position
+                item.geocoded = key
+                break
+        return item
+
+    def stats(self):
+        return { 'places': len(self.places),
+                'hits': self.hits,
+                'loaded': self.loaded,
+                'resolved': self.resolved
+                }
+
+geocoder = Geocoder()
@@ -0,0 +1,234 @@
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from datetime import datetime
+import logging
+import threading
+import time
+import urllib
+import simplejson
+from model import Report, bump_generation
+import recent
+import rollups
+from buckets import bucket_cache
+
+## how submitted reports reach the datastore
+##   'sync'   put before answering, one entity per request. the submitter's
+##            redirect shows their report
+##   'memory' opt-in: buffered in this instance and put in batches, only when
+##            this same instance serves another request after MAX_DELAY.
+##            acked before the put, so lost if the instance dies first, and
+##            the submitter may not see their report until then
+##   'queue'  added to the 'reports' pull queue (durable), /tasks/flush_reports
+##            puts them in batches every minute
+DURABILITY = 'sync'
+
+## flush when this many reports are waiting ...
+BATCH_SIZE = 100
+## ... or the oldest has waited this long (seconds)
+MAX_DELAY = 2.0
+## past this many unflushed reports submit() refuses new ones
+MAX_PENDING = 2000
+
+QUEUE_NAME = 'reports'
+
+## longest name / text / area / city, db.StringProperty refuses more
+MAX_STRING = 500
+
+class QueueFull(Exception):
+    pass
+
+def clean_report(raw):
+    """Validate a dict of report fields into a dict for build_report.
+
+    Values may be form strings or json values. Raises ValueError with a
+    message for the form's error line.
+    """
+    try:
+        lat = float(raw.get('lat'))
+        lng = float(raw.get('lng'))
+    except (TypeError, ValueError):
+        raise ValueError('please pick a location on the map')
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError('location is off the map')
+    try:
+        water = int(raw.get('water'))
+    except (TypeError, ValueError):
+        raise ValueError('please pick a water level')
+    if not 0 <= water <= 8:
+        raise ValueError('please pick a water level')
+    for field in ('name', 'text', 'area', 'city'):
+        value = raw.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, basestring):
+            raise ValueError('%s must be text' % field)
+        if len(value) > MAX_STRING:
+            raise ValueError('%s is too long, %d characters at most' % (field, MAX_STRING))
+    return { 'name': raw.get('name') or '',
+            'water': water,
+            ## the form sends the strings 'True' / 'False'
+            'road': raw.get('road') in (True, 'True', 'true'),
+            'text': raw.get('text') or '',
+            'lat': lat,
+            'lng': lng,
+            ## kept when given (imported rows), else filled in by build_report
+            'area': raw.get('area') or None,
+            'city': raw.get('city') or None
+            }
+
+def parse_report(get):
+    ## the report form, get = request.get
+    return clean_report(dict([(f, urllib.unquote(get(f)))
+                              for f in ('name', 'water', 'road', 'text', 'lat', 'lng')]))
+
+def build_report(title, fields, date=None):
+    report = Report()
+    report.title = title
+    report.name = fields['name']
+    report.set_location(fields['lat'], fields['lng'])
+    report.water = fields['water']
+    report.text = fields['text']
+    report.road = fields['road']
+    report.area = fields.get('area') or rollups.locate(fields['lat'], fields['lng'])
+    report.city = fields.get('city')
+    if date is not None:
+        report.date = date
+    return report
+
+def put_reports(reports):
+    ## one multi-put, then one generation bump per title for the batch
+    db.put(reports)
+    titles = {}
+    for r in reports:
+        titles.setdefault(r.title, []).append(r)
+    for title, batch in titles.items():
+        ## counted by a push task, not in this request
+        rollups.add_reports(title, batch)
+        generation = bump_generation(title)
+        recent.add_reports(title, batch, generation)
+        bucket_cache.written(title, batch)
+
+class ReportQueue():
+    """Write-behind buffer for submitted reports.
+
+    submit() validates nothing (see parse_report) and returns as soon as the
+    report is buffered. The buffer is put with one db.put() when it holds
+    BATCH_SIZE reports or its oldest report is MAX_DELAY old, checked on
+    every submit() and flush_if_due() call, since there is no background
+    thread to do it.
+    """
+
+    def __init__(self, durability=DURABILITY, batch_size=BATCH_SIZE,
+                 max_delay=MAX_DELAY, max_pending=MAX_PENDING):
+        self.durability = durability
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.pending = []
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.flushed = 0
+        self.batches = 0
+        self.rejected = 0
+
+    def submit(self, title, fields):
+        self.submitted += 1
+        if self.durability == 'sync':
+            put_reports([build_report(title, fields)])
+            return
+        if self.durability == 'queue':
+            payload = simplejson.dumps({ 'title': title,
+                                       'fields': fields,
+                                       'date': time.time() })
+            try:
+                taskqueue.Queue(QUEUE_NAME).add(
+                        taskqueue.Task(payload=payload, method='PULL'))
+            except taskqueue.TransientError:
+                self.rejected += 1
+                raise QueueFull()
+            return
+
+        self.lock.acquire()
+        try:
+            if len(self.pending) >= self.max_pending:
+                ## try to make room before pushing back on the client
+                self._flush()
+                if len(self.pending) >= self.max_pending:
+                    self.rejected += 1
+                    raise QueueFull()
+            if not self.pending:
+                self.oldest = time.time()
+            self.pending.append(build_report(title, fields))
+            if self._due():
+                self._flush()
+        finally:
+            self.lock.release()
+
+    def _due(self):
+        return self.pending and (len(self.pending) >= self.batch_size or
+                                 time.time() - self.oldest >= self.max_delay)
+
+    def _flush(self):
+        while self.pending:
+            batch = self.pending[:self.batch_size]
+            try:
+                put_reports(batch)
+            except db.Error, e:
+                ## keep them for the next flush
+                logging.warning('report flush of %d failed: %s', len(batch), e)
+                return
+            del self.pending[:len(batch)]
+            self.flushed += len(batch)
+            self.batches += 1
+        self.oldest = None
+
+    def flush_if_due(self):
+        if not self._due():
+            return
+        self.lock.acquire()
+        try:
+            if self._due():
+                self._flush()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self._flush()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return { 'durability': self.durability,
+                'pending': len(self.pending),
+                'submitted': self.submitted,
+                'flushed': self.flushed,
+                'batches': self.batches,
+                'rejected': self.rejected
+                }
+
+report_queue = ReportQueue()
+
+def drain_queue(batch_size=BATCH_SIZE, max_batches=20):
+    """Put reports waiting in the pull queue, batch_size per db.put().
+
+    A leased task is only deleted after its report is stored, so a failed
+    run leaves them to be leased again once the lease runs out.
+    """
+    queue = taskqueue.Queue(QUEUE_NAME)
+    stored = 0
+    for i in range(max_batches):
+        tasks = queue.lease_tasks(60, batch_size)
+        if not tasks:
+            break
+        reports = []
+        for task in tasks:
+            data = simplejson.loads(task.payload)
+            reports.append(build_report(data['title'], data['fields'],
+                                        datetime.utcfromtimestamp(data['date'])))
+        put_reports(reports)
+        queue.delete_tasks(tasks)
+        stored += len(reports)
+    return stored
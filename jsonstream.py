@@ -0,0 +1,145 @@
+from cStringIO import StringIO
+import gzip
+import itertools
+import threading
+import simplejson
+
+## elements are encoded this many at a time, one encode() call each
+BATCH_SIZE = 500
+GZIP_LEVEL = 6
+## bodies up to this size are kept by BodyCache, plain and gzipped ...
+MAX_CACHED_BODY = 1024 * 1024
+## ... until they add up to this much, then the cache starts over
+BODY_CACHE_BYTES = 16 * 1024 * 1024
+
+encoder = simplejson.JSONEncoder()
+
+def iter_array(*iterables):
+    """JSON text of one array holding the elements of all iterables.
+
+    Elements are encoded BATCH_SIZE at a time as the iterables are
+    consumed, so neither the elements nor the whole document need to be
+    in memory at once. The text is the same as simplejson.dumps(list).
+    """
+    separator = '['
+    batch = []
+    for iterable in iterables:
+        for element in iterable:
+            batch.append(element)
+            if len(batch) == BATCH_SIZE:
+                yield separator + encoder.encode(batch)[1:-1]
+                separator = ', '
+                batch = []
+    if batch:
+        yield separator + encoder.encode(batch)[1:-1]
+    elif separator == '[':
+        yield '['
+    yield ']'
+
+def accepts_gzip(request):
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+def coded_etag(etag, compress):
+    ## the gzipped body is another representation, so it gets its own
+    ## strong ETag: '"abc"' -> '"abc-gz"'
+    if compress:
+        return etag[:-1] + '-gz"'
+    return etag
+
+def write_chunks(response, chunks, content_type, compress=False):
+    ## writes chunks to response.out, gzipped (with the header) if asked
+    response.headers['Content-Type'] = content_type
+    if not compress:
+        for chunk in chunks:
+            response.out.write(chunk)
+        return
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    out = gzip.GzipFile(mode='wb', fileobj=response.out, compresslevel=GZIP_LEVEL)
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        out.close()
+
+def gzip_body(body):
+    buf = StringIO()
+    out = gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=GZIP_LEVEL)
+    try:
+        out.write(body)
+    finally:
+        out.close()
+    return buf.getvalue()
+
+class BodyCache():
+    """Response bodies by strong ETag, each kept plain and gzipped.
+
+    The key is the ETag of the plain body, the gzipped one goes out under
+    coded_etag().
+
+    A body is encoded and compressed once, however many clients then ask
+    for the same ETag. Bodies over MAX_CACHED_BODY are streamed as before
+    and not kept.
+    """
+
+    def __init__(self, max_bytes=BODY_CACHE_BYTES, max_body=MAX_CACHED_BODY):
+        self.max_bytes = max_bytes
+        self.max_body = max_body
+        self.bodies = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.streamed = 0
+
+    def put(self, etag, content_type, body):
+        cached = (content_type, body, gzip_body(body))
+        self.lock.acquire()
+        try:
+            if self.size + len(body) > self.max_bytes:
+                self.bodies.clear()
+                self.size = 0
+            if etag not in self.bodies:
+                self.bodies[etag] = cached
+                self.size += len(body) + len(cached[2])
+        finally:
+            self.lock.release()
+        return cached
+
+    def write(self, response, etag, content_type, chunks, compress=False):
+        ## write the body for etag, from the cache or by joining chunks
+        cached = self.bodies.get(etag)
+        if cached is not None:
+            self.hits += 1
+        else:
+            chunks = iter(chunks)
+            buffered = []
+            size = 0
+            for chunk in chunks:
+                buffered.append(chunk)
+                size += len(chunk)
+                if size > self.max_body:
+                    self.streamed += 1
+                    write_chunks(response, itertools.chain(buffered, chunks),
+                                 content_type, compress)
+                    return
+            self.misses += 1
+            cached = self.put(etag, content_type, ''.join(buffered))
+        content_type, body, gzipped = cached
+        response.headers['Content-Type'] = content_type
+        response.headers['Vary'] = 'Accept-Encoding'
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+            response.out.write(gzipped)
+        else:
+            response.out.write(body)
+
+    def stats(self):
+        return { 'bodies': len(self.bodies),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'streamed': self.streamed
+                }
+
+body_cache = BodyCache()
@@ -14,6 +14,10 @@ __author__ = 'lisbakke@google.com (Ben Lisbakken)'
 import os
 import math
 import cgi
+import logging
+import random
+import threading
+import time
 from django.utils import simplejson
 import wsgiref.handlers
 
@@ -25,6 +29,11 @@ from google.appengine.ext.webapp import template
 
 import urllib
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 
 class SavedMapPoint(db.Model):
   """This is the data store class that is used to save map points.
@@ -91,11 +100,14 @@ class LastPosition(db.Model):
       is optional -- if the LastPosition had one result, use this.
     user: A UserProperty to associate the record with a user.
     zoom_level: String of the zoom level of the last position saved.
+    search_results: JSON of the DoSearch result for q, so the view can be
+      re-rendered at another zoom level without searching again.
   """
   q = db.StringProperty()
   saved_map_key = db.StringProperty()
   user = db.UserProperty()
   zoom_level = db.StringProperty()
+  search_results = db.TextProperty()
 
 
 # Specifies the size of the map (in pixels).
@@ -152,7 +164,7 @@ class MercatorProjection():
     zoom_levels = range(0, zoom_levels)
     for z in zoom_levels:
       origin = self.pixels / 2
-      self.pixels_per_lon_degree.append(self.pixels / 360)
+      self.pixels_per_lon_degree.append(self.pixels / 360.0)
       self.pixels_per_lon_radian.append(self.pixels / (2 * math.pi))
       self.pixel_origo.append(Point(origin, origin))
       self.pixel_range.append(self.pixels)
@@ -184,16 +196,104 @@ class MercatorProjection():
         (1 - siny)) * -self.pixels_per_lon_radian[zoom])
     return Point(x, y)
 
+  def FromLatLngsToPixels(self, lats, lngs, zoom):
+    """Batch version of FromLatLngToPixel for one zoom level.
+
+    Uses NumPy when it is available and a plain Python loop otherwise.
+    Either way the result matches FromLatLngToPixel point for point.
+
+    Args:
+      lats: A sequence of latitudes.
+      lngs: A sequence of longitudes, the same length as lats.
+      zoom: The zoom level to project at.
+
+    Returns:
+      A tuple (xs, ys) of pixel coordinates: NumPy float arrays, or lists
+      of floats without NumPy.
+    """
+    return self.FromLatLngsToPixelsAllZooms(lats, lngs, [zoom])[0]
+
+  def FromLatLngsToPixelsAllZooms(self, lats, lngs, zooms=None):
+    """Projects many lat/lngs to pixels at several zoom levels at once.
+
+    The expensive part of the projection (the sin/log of the latitude) does
+    not depend on the zoom, so it is computed once per point and only scaled
+    per zoom level.
+
+    Args:
+      lats: A sequence of latitudes.
+      lngs: A sequence of longitudes, the same length as lats.
+      zooms: A list of zoom levels.  Optional, defaults to every zoom level
+        of this projection.
+
+    Returns:
+      A list with one (xs, ys) tuple per zoom in zooms, as returned by
+      FromLatLngsToPixels.
+    """
+    if zooms is None:
+      zooms = range(len(self.pixel_range))
+    if numpy is not None:
+      return self._ProjectNumpy(lats, lngs, zooms)
+    return self._ProjectPython(lats, lngs, zooms)
+
+  def _ProjectNumpy(self, lats, lngs, zooms):
+    lats = numpy.asarray(lats, dtype=float)
+    lngs = numpy.asarray(lngs, dtype=float)
+    siny = numpy.clip(numpy.sin(lats * (math.pi / 180)), -0.9999, 0.9999)
+    mercator = 0.5 * numpy.log((1 + siny) / (1 - siny))
+    result = []
+    for z in zooms:
+      o = self.pixel_origo[z]
+      xs = RoundHalfUp(o.x + lngs * self.pixels_per_lon_degree[z])
+      ys = RoundHalfUp(o.y + mercator * -self.pixels_per_lon_radian[z])
+      result.append((xs, ys))
+    return result
+
+  def _ProjectPython(self, lats, lngs, zooms):
+    mercator = []
+    for lat in lats:
+      siny = Bound(math.sin(DegreesToRadians(lat)), -0.9999, 0.9999)
+      mercator.append(0.5 * math.log((1 + siny) / (1 - siny)))
+    result = []
+    for z in zooms:
+      o = self.pixel_origo[z]
+      degree = self.pixels_per_lon_degree[z]
+      radian = -self.pixels_per_lon_radian[z]
+      xs = [round(o.x + lng * degree) for lng in lngs]
+      ys = [round(o.y + m * radian) for m in mercator]
+      result.append((xs, ys))
+    return result
+
+  def FitsAtZoom(self, bounds, view_size, zoom):
+    """Returns True if bounds fit in view_size pixels at this zoom level.
+
+    Args:
+      bounds: Southwest/northeast bounds, as in CalculateBoundsZoomLevel.
+      view_size: A list containing the width/height in pixels of the map.
+      zoom: The zoom level to test.
+
+    Returns:
+      A bool.
+    """
+    bottom_left_pixel = self.FromLatLngToPixel(bounds[0], zoom)
+    top_right_pixel = self.FromLatLngToPixel(bounds[1], zoom)
+    if bottom_left_pixel.x > top_right_pixel.x :
+      bottom_left_pixel.x -= self.CalcWrapWidth(zoom)
+    return abs(top_right_pixel.x - bottom_left_pixel.x) <= view_size[0] \
+        and abs(top_right_pixel.y - bottom_left_pixel.y) <= view_size[1]
+
   def CalculateBoundsZoomLevel(self, bounds, view_size):
     """Given lat/lng bounds, returns map zoom level.
 
     This method is used to take in a bounding box (southwest and northeast 
     bounds of the map view we want) and a map size and it will return us a zoom 
-    level for our map.  We use this because if we take the bottom left and 
-    upper right on the map we want to show, and calculate what pixels they 
-    would be on the map for a given zoom level, then we can see how many pixels 
-    it will take to display the map at this zoom level.  If our map size is 
-    within this many pixels, then we have the right zoom level.
+    level for our map.  Each zoom level doubles the pixel size of the bounds, 
+    so the zoom is estimated directly as log2(view size / pixel span at zoom 0).
+    Pixel rounding can put that estimate one level off, so it is then moved to 
+    the highest zoom that FitsAtZoom accepts.  That gives the same answer as 
+    CalculateBoundsZoomLevelBySearch while projecting only two or three zooms 
+    instead of up to eighteen.  Bounds across the antimeridian still use the 
+    search.
 
     Args:
       bounds: A list of length 2, each holding a list of length 2. It holds
@@ -204,26 +304,122 @@ class MercatorProjection():
     Returns:
       An int zoom level.
     """
-    zmax = 18
-    zmin = 0
-    bottom_left = bounds[0]
-    top_right = bounds[1]
-    backwards_range = range(zmin, zmax)
+    zmax = len(self.pixel_range)
+    lng_span = bounds[1][1] - bounds[0][1]
+    if lng_span < 0:
+      # Bounds across the antimeridian: whether the wrap applies depends on 
+      # pixel rounding at each zoom, so the fit is not monotonic in zoom.
+      return self.CalculateBoundsZoomLevelBySearch(bounds, view_size)
+    spans = [lng_span * self.pixels_per_lon_degree[0],
+             abs(MercatorY(bounds[1][0]) - MercatorY(bounds[0][0])) *
+             self.pixels_per_lon_radian[0]]
+    z = zmax - 1
+    for span, size in zip(spans, view_size):
+      if span > 0:
+        # A zero-pixel view still fits spans that round to zero pixels.
+        size = max(size, 0.5)
+        z = min(z, int(math.floor(math.log(size / span, 2))))
+    z = max(z, 0)
+    while z + 1 < zmax and self.FitsAtZoom(bounds, view_size, z + 1):
+      z += 1
+    while z > 0 and not self.FitsAtZoom(bounds, view_size, z):
+      z -= 1
+    return z
+
+  def CalculateBoundsZoomLevelBySearch(self, bounds, view_size):
+    """Reference version of CalculateBoundsZoomLevel.
+
+    Tries every zoom level from the highest down and returns the first one 
+    where the bounds fit.  Kept to check CalculateBoundsZoomLevel against.
+
+    Args:
+      bounds: Southwest/northeast bounds, as in CalculateBoundsZoomLevel.
+      view_size: A list containing the width/height in pixels of the map.
+
+    Returns:
+      An int zoom level.
+    """
+    backwards_range = range(0, len(self.pixel_range))
     backwards_range.reverse()
     for z in backwards_range:
-      bottom_left_pixel = self.FromLatLngToPixel(bottom_left, z)
-      top_right_pixel = self.FromLatLngToPixel(top_right, z)
-      if bottom_left_pixel.x > top_right_pixel.x :
-        bottom_left_pixel.x -= self.CalcWrapWidth(z)
-      if abs(top_right_pixel.x - bottom_left_pixel.x) <= view_size[0] \
-          and abs(top_right_pixel.y - bottom_left_pixel.y) <= view_size[1] :
+      if self.FitsAtZoom(bounds, view_size, z):
         return z
     return 0
 
+  def CalculateBoundsZoomLevels(self, bounds_list, view_sizes):
+    """Batch version of CalculateBoundsZoomLevel.
+
+    Projects all corners at every zoom level with FromLatLngsToPixelsAllZooms 
+    (vectorized when NumPy is available) and keeps the highest zoom at which 
+    each bounds fits.
+
+    Args:
+      bounds_list: A list of bounds, each as in CalculateBoundsZoomLevel.
+      view_sizes: One [width, height] for all bounds, or a list with one 
+        [width, height] per bounds.
+
+    Returns:
+      A list of int zoom levels, one per bounds.
+    """
+    n = len(bounds_list)
+    if n and not isinstance(view_sizes[0], (list, tuple)):
+      view_sizes = [view_sizes] * n
+    widths = [size[0] for size in view_sizes]
+    heights = [size[1] for size in view_sizes]
+    bottom_left = self.FromLatLngsToPixelsAllZooms(
+        [b[0][0] for b in bounds_list], [b[0][1] for b in bounds_list])
+    top_right = self.FromLatLngsToPixelsAllZooms(
+        [b[1][0] for b in bounds_list], [b[1][1] for b in bounds_list])
+    if numpy is not None:
+      widths = numpy.asarray(widths)
+      heights = numpy.asarray(heights)
+      zooms = numpy.zeros(n, dtype=int)
+      for z in range(len(self.pixel_range)):
+        blx, bly = bottom_left[z]
+        trx, try_ = top_right[z]
+        blx = numpy.where(blx > trx, blx - self.CalcWrapWidth(z), blx)
+        fits = (abs(trx - blx) <= widths) & (abs(try_ - bly) <= heights)
+        zooms = numpy.where(fits, z, zooms)
+      return zooms.tolist()
+    zooms = [0] * n
+    for z in range(len(self.pixel_range)):
+      blx, bly = bottom_left[z]
+      trx, try_ = top_right[z]
+      wrap = self.CalcWrapWidth(z)
+      for i in range(n):
+        x = blx[i]
+        if x > trx[i]:
+          x -= wrap
+        if abs(trx[i] - x) <= widths[i] and abs(try_[i] - bly[i]) <= heights[i]:
+          zooms[i] = z
+    return zooms
+
     
 def DegreesToRadians(deg):
   return deg * (math.pi / 180)
 
+
+def MercatorY(lat):
+  """Returns the unscaled Mercator y of a latitude, as FromLatLngToPixel does.
+
+  Args:
+    lat: The latitude in degrees.
+
+  Returns:
+    A float, multiply by pixels_per_lon_radian to get pixels.
+  """
+  siny = Bound(math.sin(DegreesToRadians(lat)), -0.9999, 0.9999)
+  return 0.5 * math.log((1 + siny) / (1 - siny))
+
+
+def RoundHalfUp(values):
+  """Rounds a NumPy array like the builtin round(), halves away from zero.
+
+  numpy.round rounds halves to even, which would put some points one pixel
+  off from FromLatLngToPixel.
+  """
+  return numpy.sign(values) * numpy.floor(numpy.abs(values) + 0.5)
+
     
 def CalcCenterFromBounds(bounds):
   """Calculates the center point given southwest/northeast lat/lng pairs.
@@ -297,7 +493,298 @@ def CalcBoundsFromPoints(lats, lngs):
   return [[south, west], [north, east]]
       
 
+# Per-zoom projection tables, built once per process.
+MERCATOR_PROJECTION = MercatorProjection(18)
+
+
+# Upstream fetch policy: seconds per attempt, retries after the first attempt,
+# RPCs in flight at once, base of the exponential retry backoff in seconds,
+# and the seconds after which no retry is started.
+FETCH_DEADLINE = 5
+FETCH_RETRIES = 2
+FETCH_PARALLELISM = 4
+FETCH_BACKOFF = 0.2
+FETCH_BUDGET = 10
+
+# LocalSearch pages fetched per query, rsz=large pages hold 8 results.  The
+# markers are lettered a-z, so at most 3 pages.
+SEARCH_PAGES = 3
+SEARCH_PAGE_SIZE = 8
+
+
+def FetchAll(urls, deadline=FETCH_DEADLINE, retries=FETCH_RETRIES,
+             parallelism=FETCH_PARALLELISM, budget=FETCH_BUDGET):
+  """Fetches urls concurrently with async urlfetch RPCs.
+
+  At most parallelism RPCs are in flight.  Each attempt gets deadline
+  seconds; a failed attempt (urlfetch error or 5xx status) is retried up to
+  retries times after an exponential backoff with random jitter, unless
+  budget seconds have passed since the call started.
+
+  Args:
+    urls: A list of urls to GET.
+    deadline: Seconds each attempt may take.
+    retries: How many times a failed url is tried again.
+    parallelism: Max RPCs in flight.
+    budget: Seconds after which failed urls are given up instead of retried.
+
+  Returns:
+    A list with the urlfetch response for each url, in the order of urls,
+    or None where every attempt failed.
+  """
+  start = time.time()
+  results = [None] * len(urls)
+  waiting = [(index, 0) for index in range(len(urls))]
+  waiting.reverse()
+  active = []
+  while waiting or active:
+    while waiting and len(active) < parallelism:
+      index, attempt = waiting.pop()
+      rpc = urlfetch.create_rpc(deadline=deadline)
+      urlfetch.make_fetch_call(rpc, urls[index])
+      active.append((rpc, index, attempt))
+    # RPCs run in the background, collecting the oldest first costs nothing
+    # for the ones started after it.
+    rpc, index, attempt = active.pop(0)
+    try:
+      response = rpc.get_result()
+      failed = response.status_code >= 500
+    except urlfetch.Error:
+      response = None
+      failed = True
+    if not failed:
+      results[index] = response
+    elif attempt < retries and time.time() - start < budget:
+      time.sleep(FETCH_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5))
+      waiting.append((index, attempt + 1))
+  return results
+
+
+class SearchCache():
+  """In-process cache of DoSearch results with TTL, LRU and single-flight.
+
+  Results are keyed by the normalized query and the map size.  Entries live
+  for ttl seconds; when the cache holds max_entries the least recently used
+  entry is evicted.  If a query is already being fetched, other requests for
+  the same key wait for that fetch instead of starting their own.  Failed
+  fetches are not cached, their exception is re-raised in every waiter.
+
+  Attributes:
+    ttl: Seconds a result is served from the cache.
+    max_entries: How many results are kept.
+  """
+
+  def __init__(self, ttl=600, max_entries=256):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    # key -> [expires, last_used, value, fetch_seconds]
+    self.entries = {}
+    # key -> [threading.Event, value, exception, fetch_seconds]
+    self.in_flight = {}
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.coalesced = 0
+    self.evictions = 0
+    self.upstream_seconds = 0.0
+    self.saved_seconds = 0.0
+
+  def Key(self, query, map_size):
+    """Returns the cache key of a query: lower case, single spaces, size.
+
+    Args:
+      query: The search string.
+      map_size: The [width, height] of the map in pixels.
+
+    Returns:
+      A tuple usable as a dict key.
+    """
+    return (' '.join(query.lower().split()), tuple(map_size))
+
+  def Get(self, key, fetch):
+    """Returns the cached value for key, calling fetch() to fill it.
+
+    Args:
+      key: A key from Key().
+      fetch: A function of no arguments that returns the fresh value.
+
+    Returns:
+      Whatever fetch() returned for this key, possibly from the cache.
+    """
+    self.lock.acquire()
+    try:
+      now = time.time()
+      entry = self.entries.get(key)
+      if entry is not None and entry[0] > now:
+        entry[1] = now
+        self.hits += 1
+        self.saved_seconds += entry[3]
+        return entry[2]
+      flight = self.in_flight.get(key)
+      if flight is None:
+        flight = [threading.Event(), None, None, 0.0]
+        self.in_flight[key] = flight
+        leader = True
+        self.misses += 1
+      else:
+        leader = False
+        self.coalesced += 1
+    finally:
+      self.lock.release()
+
+    if not leader:
+      flight[0].wait()
+      if flight[2] is not None:
+        raise flight[2]
+      self.lock.acquire()
+      try:
+        self.saved_seconds += flight[3]
+      finally:
+        self.lock.release()
+      return flight[1]
+
+    start = time.time()
+    try:
+      value = fetch()
+    except Exception, e:
+      flight[2] = e
+      self.lock.acquire()
+      try:
+        del self.in_flight[key]
+      finally:
+        self.lock.release()
+      flight[0].set()
+      raise
+    elapsed = time.time() - start
+    flight[1] = value
+    flight[3] = elapsed
+    self.lock.acquire()
+    try:
+      self.upstream_seconds += elapsed
+      if key not in self.entries and len(self.entries) >= self.max_entries:
+        self._EvictOne()
+      now = time.time()
+      self.entries[key] = [now + self.ttl, now, value, elapsed]
+      del self.in_flight[key]
+    finally:
+      self.lock.release()
+    flight[0].set()
+    return value
+
+  def _EvictOne(self):
+    """Drops expired entries, or else the least recently used one."""
+    now = time.time()
+    expired = [k for k, e in self.entries.items() if e[0] <= now]
+    if not expired:
+      expired = [min(self.entries.items(), key=lambda item: item[1][1])[0]]
+    for k in expired:
+      del self.entries[k]
+    self.evictions += len(expired)
+
+  def Stats(self):
+    """Returns the cache counters as a dict.
+
+    saved_seconds is the upstream time that hits and coalesced requests did
+    not spend, counted as the duration of the fetch that served them.
+    """
+    lookups = self.hits + self.misses + self.coalesced
+    return {
+      'entries': len(self.entries),
+      'hits': self.hits,
+      'misses': self.misses,
+      'coalesced': self.coalesced,
+      'evictions': self.evictions,
+      'hit_rate': lookups and float(self.hits + self.coalesced) / lookups,
+      'upstream_seconds': self.upstream_seconds,
+      'saved_seconds': self.saved_seconds
+    }
+
+
+SEARCH_CACHE = SearchCache()
+
+
 def DoSearch(query, MAP_SIZE):
+  """Returns the LocalSearch result for a query, cached in SEARCH_CACHE.
+
+  Args:
+    query: The query that will be used for the search.
+    MAP_SIZE: The size of the map that the points will be displayed on.
+
+  Returns:
+    The dict described in FetchSearch, or None if nothing was found.  The
+    dict is shared between requests and must not be modified.
+
+  Raises:
+    urlfetch.Error: LocalSearch could not be reached, nothing is cached.
+  """
+  return SEARCH_CACHE.Get(SEARCH_CACHE.Key(query, MAP_SIZE),
+                          lambda: FetchSearch(query, MAP_SIZE))
+
+
+def DoSearchOrNone(query, MAP_SIZE):
+  """Returns DoSearch(query, MAP_SIZE), or None if LocalSearch is down.
+
+  For the handlers, which show bad_search.html either way.  The outage
+  itself is not cached, the next request tries again.
+
+  Args:
+    query: The query that will be used for the search.
+    MAP_SIZE: The size of the map that the points will be displayed on.
+
+  Returns:
+    The dict described in FetchSearch, or None.
+  """
+  try:
+    return DoSearch(query, MAP_SIZE)
+  except urlfetch.Error, e:
+    logging.warning('LocalSearch for %r failed: %s', query, e)
+    return None
+
+
+def FetchSearchPages(query, pages=SEARCH_PAGES):
+  """Fetches the first pages of LocalSearch results for a query in parallel.
+
+  Args:
+    query: The query that will be used for the search.
+    pages: How many rsz=large pages to fetch.
+
+  Returns:
+    The decoded response of the first page, with the results of the later
+    pages appended to its results (duplicates dropped), or None if
+    nothing was found.  A later page that fails or comes back empty just
+    contributes nothing.
+
+  Raises:
+    urlfetch.Error: The first page could not be fetched.
+  """
+  query = urllib.urlencode({'q' : query})
+  urls = ['http://ajax.googleapis.com/ajax/services/search/local?'
+          'key=%s&v=1.0&%s&rsz=large&start=%d' %
+          (MAP_KEY, query, page * SEARCH_PAGE_SIZE) for page in range(pages)]
+  responses = FetchAll(urls)
+  if responses[0] is None:
+    raise urlfetch.Error('no answer for the first page')
+  json = simplejson.loads(responses[0].content)
+  if not json.get('responseData'):
+    return None
+  results = json['responseData']['results']
+  seen = set([(r['lat'], r['lng'], r['titleNoFormatting']) for r in results])
+  for response in responses[1:]:
+    if response is None:
+      continue
+    try:
+      page = simplejson.loads(response.content)['responseData']['results']
+    except (ValueError, KeyError, TypeError):
+      continue
+    for r in page:
+      key = (r['lat'], r['lng'], r['titleNoFormatting'])
+      if key not in seen:
+        seen.add(key)
+        results.append(r)
+  return json
+
+
+def FetchSearch(query, MAP_SIZE):
   """Uses AJAX LocalSearch API to search Google Maps for a query.
 
   Given a query and map size, this method starts a search for us.  It will use 
@@ -334,12 +821,15 @@ def DoSearch(query, MAP_SIZE):
     
     Note that display_results is a list and can have multiple dict entries, 
     each representing a search result from the LocalSearch query.
+
+    None if nothing was found.
+
+  Raises:
+    urlfetch.Error: The first page of results could not be fetched.
   """
-  query = urllib.urlencode({'q' : query})
-  url = 'http://ajax.googleapis.com/ajax/services/search/local?' \
-      'key=%s&v=1.0&%s&rsz=large' % (MAP_KEY, query)
-  local_search_points = urlfetch.fetch(url)
-  json = simplejson.loads(local_search_points.content)
+  json = FetchSearchPages(query)
+  if json is None:
+    return None
   points = json['responseData']['results']
   markers = ''
   index = 0
@@ -374,7 +864,7 @@ def DoSearch(query, MAP_SIZE):
     return None
   if len(points) == 1:
     viewport = json['responseData']['viewport']
-    mercator_projection = MercatorProjection(18)
+    mercator_projection = MERCATOR_PROJECTION
     southwest = [float(viewport['sw']['lat']),float(viewport['sw']['lng'])]
     northeast = [float(viewport['ne']['lat']),float(viewport['ne']['lng'])]
     bounds = [southwest, northeast]
@@ -387,7 +877,7 @@ def DoSearch(query, MAP_SIZE):
       'display_results': display_results
     }
   else:
-    mercator_projection = MercatorProjection(18)
+    mercator_projection = MERCATOR_PROJECTION
     bounds = CalcBoundsFromPoints(lats, lngs)
     center_point = CalcCenterFromBounds(bounds)
     zoom_level = mercator_projection.CalculateBoundsZoomLevel(bounds, MAP_SIZE)
@@ -478,7 +968,7 @@ def SaveLastSinglePoint(lat, lng, title, url, street_address, region, city,
   last_point.put()
 
 
-def SaveLastSearch(q, zoom_level):
+def SaveLastSearch(q, zoom_level, rs=None, last_point=None):
   """Saves last map search in datastore so last view can be restored.
 
   This method is used when we want to save the last map view if there were 
@@ -489,22 +979,45 @@ def SaveLastSearch(q, zoom_level):
   Args:
   q: The query.
   zoom_level: The zoom level that the search was saved at.
+  rs: The DoSearch result for q, stored as the search snapshot.
+  last_point: The user's LastPosition if the caller already has it.
 
   Returns:
     Nothing.
   """
-  last_point = RetrieveLastPoint()
+  if last_point is None:
+    last_point = RetrieveLastPoint()
   if last_point is None:
     last_point = LastPosition()
   if last_point.saved_map_key:
     DeleteByKey(last_point.saved_map_key)
     last_point.saved_map_key = None
+  if rs is not None:
+    last_point.search_results = simplejson.dumps(rs)
+  elif last_point.q != q:
+    last_point.search_results = None
   last_point.q = q
   last_point.zoom_level = str(zoom_level)
   last_point.user = users.get_current_user()
   last_point.put()
 
 
+def LoadLastSearch(last_point, q):
+  """Returns the search snapshot of a LastPosition if it is for query q.
+
+  Args:
+    last_point: A LastPosition, or None.
+    q: The query the caller wants results for.
+
+  Returns:
+    The DoSearch result dict stored by SaveLastSearch, or None if there is
+    no snapshot for q.
+  """
+  if last_point is None or last_point.q != q or not last_point.search_results:
+    return None
+  return simplejson.loads(last_point.search_results)
+
+
 def RetrieveLastPoint():
   """Returns the data for the last map view accessed.
 
@@ -854,7 +1367,12 @@ class Zoom(webapp.RequestHandler):
       SaveLastSinglePoint(lat, lng, title, url, street_address, region, city,
                           zoom_level, phone)
     else:
-      rs = DoSearch(q, MAP_SIZE)
+      # Only the zoom level changed, re-render the stored results.
+      last_point = RetrieveLastPoint()
+      rs = LoadLastSearch(last_point, q)
+      fetched = None
+      if rs is None:
+        rs = fetched = DoSearchOrNone(q, MAP_SIZE)
       if rs is None:
         path = os.path.join(os.path.dirname(__file__), 'bad_search.html')
         self.response.out.write(template.render(path, self.template_values))
@@ -863,7 +1381,7 @@ class Zoom(webapp.RequestHandler):
       self.template_values['lng'] = rs['lng']
       self.template_values['markers'] = rs['markers']
       self.template_values['search_results'] = rs['display_results']
-      SaveLastSearch(q, zoom_level)
+      SaveLastSearch(q, zoom_level, fetched, last_point)
       
       
 
@@ -896,7 +1414,7 @@ class Search(webapp.RequestHandler):
     greeting = SetGreeting(self)
     q = self.request.get('q')
     self.template_values = {}
-    rs = DoSearch(q, MAP_SIZE)
+    rs = DoSearchOrNone(q, MAP_SIZE)
     if rs is None:
       path = os.path.join(os.path.dirname(__file__), 'bad_search.html')
       self.response.out.write(template.render(path, self.template_values))
@@ -911,7 +1429,7 @@ class Search(webapp.RequestHandler):
     SetDefaultTemplateValues(self, MAP_SIZE, MAP_KEY, greeting, q, 
         FindAllSavedPoints())
     
-    SaveLastSearch(q, rs['zoom'])
+    SaveLastSearch(q, rs['zoom'], rs)
     path = os.path.join(os.path.dirname(__file__), 'local.html')
     self.response.out.write(template.render(path, self.template_values))
 
@@ -956,7 +1474,9 @@ class MainPage(webapp.RequestHandler):
                                                 city, url, phone)
       else:
         q = last_point.q
-        rs = DoSearch(q, MAP_SIZE)
+        rs = LoadLastSearch(last_point, q)
+        if rs is None:
+          rs = DoSearchOrNone(q, MAP_SIZE)
         if rs is None:
           path = os.path.join(os.path.dirname(__file__), 'bad_search.html')
           self.response.out.write(template.render(path, self.template_values))
@@ -969,7 +1489,7 @@ class MainPage(webapp.RequestHandler):
         
     else:
       q = 'los angeles'
-      rs = DoSearch(q, MAP_SIZE)
+      rs = DoSearchOrNone(q, MAP_SIZE)
       if rs is None:
         path = os.path.join(os.path.dirname(__file__), 'bad_search.html')
         self.response.out.write(template.render(path, self.template_values))
@@ -988,6 +1508,27 @@ class MainPage(webapp.RequestHandler):
     self.response.out.write(template.render(path, self.template_values))
 
 
+class SearchStats(webapp.RequestHandler):
+  """Shows the SEARCH_CACHE counters of this instance to admins.
+
+  Attributes:
+    None.
+  """
+  def get(self):
+    """Handles an HTTP Get to /search_stats.
+
+    Returns:
+      SEARCH_CACHE.Stats() as JSON, or a 403 for anyone but an admin.
+    """
+    if not users.is_current_user_admin():
+      self.error(403)
+      return
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(simplejson.dumps(SEARCH_CACHE.Stats(),
+                                             sort_keys=True, indent=1))
+
+
 def main():
   """Handles all requests and routes them to the correct code.
 
@@ -1002,7 +1543,8 @@ def main():
       ('/zoom', Zoom),
       ('/focus', Focus),
       ('/save', Save),
-      ('/delete', Delete)],
+      ('/delete', Delete),
+      ('/search_stats', SearchStats)],
       debug=True)
   wsgiref.handlers.CGIHandler().run(application)
   
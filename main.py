@@ -17,14 +17,35 @@
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import util
 from google.appengine.ext.webapp import template
-from model import Report
+from model import Report, MAP_FIELDS, get_generation, get_modified
 import os
 import urllib
+import calendar
+import hashlib
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from datetime import date, datetime, time, timedelta
+from google.appengine.ext import db
 from google.appengine.ext.db import djangoforms
 import simplejson
 import pprint
-from feedparser import FeedFMSParser
+from feedparser import feed_cache
+from cluster import cluster_cache, ClusterSet
+from tiles import tile_cache, TileSet
+import cluster
+import tiles
+import geo
+import recent
+import jsonstream
+from jsonstream import body_cache
+from render import template_cache
+import wire
+import itertools
+from ingest import report_queue, parse_report, QueueFull
+from buckets import bucket_cache, MAX_DAYS
+from geocode import geocoder
+from bulk import ReportExport, import_lines
+import bulk
+import rollups
 
 
 
@@ -32,82 +53,294 @@ title = 'WaterReport'
 
 days = 3
 
-def get_startDay():
+## clusters/tiles are rebuilt at least this often (minutes), so reports
+## that slide out of the window disappear from them
+CLUSTER_MINUTES = 10
+
+## seconds browsers/CDNs may reuse a tile before revalidating its ETag
+TILE_MAX_AGE = 60
+
+## a fresh ?since= poll also re-reads this far behind its cursor, in case
+## the clocks of two instances disagree. clients drop ids they already
+## have. 'more' continuations resume the query and re-read nothing
+DELTA_OVERLAP = timedelta(seconds=5)
+DELTA_LIMIT = 500
+
+def get_startDay(days=days):
     deltaDays = timedelta(days)
     endDate = datetime.now()
     startDate = endDate - deltaDays          
     return startDate
 
+def query_reports(title, startDate, cells=None):
+    ## projected: the results only have date, lat, lng, water and the key
+    reports = Report.all(projection=('date',) + MAP_FIELDS)
+    reports.filter('title', title)
+    if cells:
+        ## one sub-query per geohash cell, merged on date by the datastore
+        reports.filter('geocells IN', cells)
+    reports.order('-date')
+    reports.filter('date >' ,startDate)
+    return reports
+
+def get_recent(title, startDate):
+    ## the recent list always holds the default (rounded) window, whoever
+    ## fills it. shorter windows are cut out of it, longer ones come
+    ## straight from the hourly buckets
+    default = window_start(get_startDay())
+    if startDate < default:
+        return bucket_cache.window(title, startDate)
+    return recent.recent_reports(title, startDate,
+            lambda: bucket_cache.window(title, default))
+
+def map_points(title, startDate, feed):
+    ## (lat, lng, water) of everything drawn on the map
+    for lat, lng, item in feed.points:
+        yield lat, lng, item['water']
+    for id, date, lat, lng, water in get_recent(title, startDate):
+        yield lat, lng, water or 0
+
+def encode_cursor(dt):
+    ## datetime (utc) -> microseconds since the epoch
+    return '%d' % (calendar.timegm(dt.timetuple()) * 1000000 + dt.microsecond)
+
+def decode_cursor(cursor):
+    value = int(cursor)
+    return datetime.utcfromtimestamp(value // 1000000).replace(microsecond=value % 1000000)
+
+def query_delta(title, since, page=None):
+    ## projected like query_reports, with modified for the cursor.
+    ## -> (reports, datastore cursor after them). page is that cursor from
+    ## the previous call with the same since: it resumes the very same
+    ## query, so a continuation neither repeats the overlap nor any row
+    reports = Report.all(projection=('modified',) + MAP_FIELDS)
+    reports.filter('title', title)
+    reports.filter('modified >', since - DELTA_OVERLAP)
+    reports.order('modified')
+    if page:
+        reports.with_cursor(page)
+    return reports.fetch(DELTA_LIMIT), reports.cursor()
+
+def window_start(startDate):
+    ## startDate rounded down to CLUSTER_MINUTES
+    return startDate.replace(second=0, microsecond=0,
+            minute=startDate.minute - startDate.minute % CLUSTER_MINUTES)
+
+def map_version(title, feed, startDate):
+    return (feed.version, get_generation(title), window_start(startDate))
+
+def data_etag(*inputs):
+    ## strong ETag of a response that only depends on inputs
+    return '"%s"' % hashlib.md5(repr(inputs)).hexdigest()
+
+def data_modified(title, window=None, feed=None, days=days):
+    ## when reports, the window (of days days, starting at window) or the
+    ## feed file last changed (epoch seconds), None if memcache lost the
+    ## report time
+    modified = get_modified(title)
+    if modified is None:
+        return None
+    if window is not None:
+        ## reports leave the window days after window start
+        modified = max(modified, calendar.timegm((window + timedelta(days)).timetuple()))
+    if feed is not None:
+        modified = max(modified, feed.modified)
+    return modified
+
+def not_modified(handler, etag, modified=None):
+    """Send ETag / Last-Modified, and a 304 if the client is up to date.
+
+    Returns True when the 304 was sent and the handler should stop.
+    If-None-Match wins over If-Modified-Since, as in RFC 2616.
+    """
+    headers = handler.request.headers
+    handler.response.headers['ETag'] = etag
+    if handler.response.headers.get('Cache-Control') is None:
+        ## keep it, but ask us before using it again
+        handler.response.headers['Cache-Control'] = 'no-cache'
+    if modified is not None:
+        handler.response.headers['Last-Modified'] = formatdate(modified, usegmt=True)
+    match = headers.get('If-None-Match')
+    if match:
+        match = [t.strip() for t in match.split(',')]
+        current = etag in match or '*' in match
+    elif modified is not None and headers.get('If-Modified-Since'):
+        since = parsedate_tz(headers.get('If-Modified-Since'))
+        current = since is not None and int(modified) <= mktime_tz(since)
+    else:
+        current = False
+    if current:
+        handler.response.set_status(304)
+    return current
+
+def get_clusters(title, startDate, feed, version, window=days):
+    ## other ?days= windows get their own slot, not the default one's
+    key = title
+    if window != days:
+        key = (title, window)
+    return cluster_cache.get(key, version,
+            lambda v: ClusterSet(v, map_points(title, startDate, feed)))
+
 class ThaiFloodReport(webapp.RequestHandler):
     def get(self):
+        report_queue.flush_if_due()
         error = urllib.unquote(self.request.get('error'))
-        startDate = get_startDay()
-        reports = Report().all().filter('title', title)
-        reports.order('-date')
-        reports.filter('date >' ,startDate)
-        template_values = {
+        startDate = window_start(get_startDay())
+        def template_values():
+            reports = get_recent(title, startDate)
+            return {
                 'title' : title,
 				'e_msg':error,
-                'reports': simplejson.dumps([r.to_dict() for r in reports]),
+                'reports': simplejson.dumps([recent.to_dict(e) for e in reports]),
                 'startDate':startDate
-        }
+            }
+        ## same reports, window and message -> same page
+        key = (title, get_generation(title), startDate, error)
         path = os.path.join(os.path.dirname(__file__), 'index.html')
-        self.response.out.write(template.render(path, template_values))
+        if not_modified(self, data_etag(key, os.stat(path).st_mtime),
+                        data_modified(title, startDate)):
+            return
+        if error:
+            ## any ?error= text would make a new entry, don't cache those
+            self.response.out.write(template_cache.render(path, template_values()))
+            return
+        self.response.out.write(template_cache.render_cached(path, key[:3], template_values))
 
 
     def post(self): 
-        request = self.request
-        report = Report()
-       #try:
-        name = urllib.unquote(self.request.get('name')) 
-        water = urllib.unquote(self.request.get('water')) 
-        road = urllib.unquote(self.request.get('road')) 
-        text = urllib.unquote(self.request.get('text')) 
-        lat = urllib.unquote(self.request.get('lat')) 
-        lng = urllib.unquote(self.request.get('lng')) 
-        
-        report.title = title
-        report.name = name
-        report.lat = float(lat)
-        report.lng = float(lng)
-        report.water = int(water)
-        report.text = text
-        report.road = bool(road)
-        report.put()
-
-#        except Exception, e:
-            #self.redirect('/ThaiFlood2011/?error=Error, %s'%e)
-        error = urllib.unquote(self.request.get('error'))
-        startDate = get_startDay()
-        
-        reports = Report().all().filter('title', title)
-        reports.order('-date')
-        reports.filter('date >' ,startDate)
-            
-        template_values = {
-                'title' : title,
-				'e_msg':error,
-                'reports': simplejson.dumps([r.to_dict() for r in reports]),
-                'startDate':startDate
-
-        }
-        path = os.path.join(os.path.dirname(__file__), 'index.html')
-        self.response.out.write(template.render(path, template_values)) 
+        try:
+            fields = parse_report(self.request.get)
+        except ValueError, e:
+            self.redirect('/%s/?error=%s' % (title, urllib.quote(str(e))))
+            return
+        try:
+            report_queue.submit(title, fields)
+        except QueueFull:
+            ## too many reports waiting for the datastore, push back
+            self.error(503)
+            self.response.headers['Retry-After'] = '10'
+            self.response.out.write('Too many reports right now, please try again shortly.')
+            return
+        ## the page itself is rendered by get(), from the recent cache
+        self.redirect('/%s/' % title)
 
 class jsonHandler(webapp.RequestHandler):
     def get(self,title):
-        startDate = get_startDay()
-        reports = Report().all()
-        reports.filter('title', title)
-        reports.order('-date')
-        reports.filter('date >' ,startDate)
-        
-        feed = FeedFMSParser()
-        final_report = feed.list_items()
-        
-        final_report += [r.to_dict() for r in reports]
-        
-        json = simplejson.dumps(final_report) 
+        report_queue.flush_if_due()
+        feed = feed_cache.get()
+        if self.request.get('since'):
+            return self.get_delta(title, feed)
+        try:
+            window = int(self.request.get('days') or days)
+            if not 0 < window <= MAX_DAYS:
+                raise ValueError('days must be 1 to %d' % MAX_DAYS)
+            bbox = self.request.get('bbox') or None
+            if bbox:
+                bbox = geo.parse_bbox(bbox)
+            zoom = self.request.get('zoom') or None
+            if zoom:
+                zoom = int(zoom)
+                if zoom < 0:
+                    raise ValueError('negative zoom')
+            format = self.request.get('format') or 'json'
+            if format != 'json' and format not in wire.FORMATS:
+                raise ValueError('unknown format %s' % format)
+        except ValueError, e:
+            self.error(400)
+            self.response.out.write('bad request: %s' % e)
+            return
+        ## rounded, so the response (and its ETag) only changes with the data
+        startDate = window_start(get_startDay(window))
+
+        ## nothing below runs for a client that has this version already
+        etag = data_etag(feed.version, feed.generation, get_generation(title),
+                         startDate, self.request.query_string)
+        compress = jsonstream.accepts_gzip(self.request)
+        ## also on a 304: the ETag depends on Accept-Encoding
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        if not_modified(self, jsonstream.coded_etag(etag, compress),
+                        data_modified(title, startDate, feed, window)):
+            return
+
+        if zoom is not None and zoom < cluster.MAX_ZOOM:
+            version = map_version(title, feed, startDate)
+            clusters = get_clusters(title, startDate, feed, version, window)
+            parts = [clusters.get(zoom, bbox)]
+        elif bbox:
+            reports = query_reports(title, startDate, geo.bbox_cells(bbox))
+            parts = [feed.in_bbox(bbox),
+                     (r.to_dict() for r in reports
+                      if geo.in_bbox(r.lat, r.lng, bbox))]
+        else:
+            parts = [feed.items,
+                     (recent.to_dict(e) for e in get_recent(title, startDate))]
+
+        if format == 'json':
+            ## one array, encoded element by element as the parts are read
+            content_type = 'application/json; charset=utf-8'
+            chunks = jsonstream.iter_array(*parts)
+        else:
+            encode, content_type = wire.FORMATS[format]
+            chunks = [encode(itertools.chain(*parts))]
+        ## kept plain and gzipped for the next client with the same ETag
+        body_cache.write(self.response, etag, content_type, chunks, compress)
+
+    def get_delta(self, title, feed):
+        ## ?since=<cursor>: reports written after the cursor, and the feed
+        ## items only if ?feed= is not the current feed version.
+        ## since=0 just hands out a cursor for "now". while 'more' is set the
+        ## cursor is 'since:newest:page', the next page of the same query
+        since = self.request.get('since')
+        page = None
+        try:
+            if since == '0':
+                since = None
+            else:
+                parts = since.split(':', 2)
+                since = newest = decode_cursor(parts[0])
+                if len(parts) == 3:
+                    newest = decode_cursor(parts[1])
+                    page = parts[2]
+                elif len(parts) != 1:
+                    raise ValueError('malformed cursor')
+        except ValueError, e:
+            self.error(400)
+            self.response.out.write('bad cursor: %s' % e)
+            return
+
+        reports = []
+        if since is None:
+            cursor = datetime.now()
+        else:
+            ## a poll with nothing new repeats its URL, answer it from here
+            etag = data_etag(feed.version, feed.generation, get_generation(title),
+                             self.request.query_string)
+            if not_modified(self, etag, data_modified(title, feed=feed)):
+                return
+            try:
+                reports, page = query_delta(title, since, page)
+            except db.BadValueError, e:
+                self.error(400)
+                self.response.out.write('bad cursor: %s' % e)
+                return
+            cursor = newest
+            if reports:
+                cursor = max(cursor, reports[-1].modified)
+        more = len(reports) == DELTA_LIMIT
+        if more:
+            next_cursor = '%s:%s:%s' % (encode_cursor(since), encode_cursor(cursor), page)
+        else:
+            next_cursor = encode_cursor(cursor)
+        delta = { 'cursor': next_cursor,
+                'more': more,
+                'feed': feed.version,
+                'reports': [dict(r.to_dict(), id=r.key().id()) for r in reports]
+                }
+        client_feed = self.request.get('feed')
+        if client_feed and client_feed != feed.version:
+            delta['items'] = feed.items
+
+        json = simplejson.dumps(delta)
         self.response.headers.add_header('content-type', 'application/json', charset='utf-8')
         self.response.out.write(json)
 
@@ -116,6 +349,96 @@ class jsonHandler(webapp.RequestHandler):
 
 
 
+class tileHandler(webapp.RequestHandler):
+    def get(self, title, z, x, y, format):
+        z, x, y = int(z), int(x), int(y)
+        if z >= tiles.MAX_ZOOM or x >= 1 << z or y >= 1 << z:
+            self.error(404)
+            return
+        startDate = window_start(get_startDay())
+        feed = feed_cache.get()
+        version = map_version(title, feed, startDate)
+        tileset = tile_cache.get(title, version,
+                lambda v: TileSet(v, get_clusters(title, startDate, feed, v)))
+        body, etag = tileset.tile(z, x, y, format)
+
+        self.response.headers['Cache-Control'] = 'public, max-age=%d' % TILE_MAX_AGE
+        if not_modified(self, etag):
+            return
+        self.response.headers.add_header('content-type', 'application/json', charset='utf-8')
+        self.response.out.write(body)
+
+class statsHandler(webapp.RequestHandler):
+    ## report counts and water level histograms per area (and city) and
+    ## day, from the rollup counters
+    def get(self, title):
+        report_queue.flush_if_due()
+        try:
+            window = int(self.request.get('days') or days)
+            if not 0 < window <= MAX_DAYS:
+                raise ValueError('days must be 1 to %d' % MAX_DAYS)
+        except ValueError, e:
+            self.error(400)
+            self.response.out.write('bad request: %s' % e)
+            return
+        ## whole days, from the one the map window starts in. that day
+        ## moved on last at its midnight plus the window
+        startDay = get_startDay(window).replace(hour=0, minute=0, second=0,
+                                                 microsecond=0)
+        first_day = rollups.day_of(startDay)
+        name = rollups.generation_name(title)
+        generation = get_generation(name)
+        if not_modified(self, data_etag('stats', title, generation, first_day),
+                        data_modified(name, startDay, days=window)):
+            return
+        json = simplejson.dumps(rollups.get_summary(title, first_day, generation))
+        self.response.headers.add_header('content-type', 'application/json', charset='utf-8')
+        self.response.out.write(json)
+
+class cacheStatsHandler(webapp.RequestHandler):
+    ## hit/miss counters of the caches of the instance that serves this
+    ## request, admin only, see app.yaml
+    def get(self):
+        json = simplejson.dumps({ 'instance': os.environ.get('INSTANCE_ID'),
+                                 'feed': feed_cache.stats(),
+                                 'geocoder': geocoder.stats(),
+                                 'buckets': bucket_cache.stats(),
+                                 'bodies': body_cache.stats(),
+                                 'templates': template_cache.stats(),
+                                 'reports': report_queue.stats()
+                                 }, sort_keys=True, indent=1)
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.headers.add_header('content-type', 'application/json', charset='utf-8')
+        self.response.out.write(json)
+
+class exportHandler(webapp.RequestHandler):
+    ## NDJSON dump of a title's reports, EXPORT_LIMIT rows per request.
+    ## admin only, see app.yaml
+    def get(self, title):
+        try:
+            limit = min(int(self.request.get('limit') or bulk.EXPORT_LIMIT),
+                        bulk.EXPORT_LIMIT)
+        except ValueError:
+            self.error(400)
+            return
+        export = ReportExport(title, self.request.get('cursor') or None, limit)
+        self.response.headers.add_header('content-type', 'application/x-ndjson', charset='utf-8')
+        for line in export:
+            self.response.out.write(line)
+        ## webapp sends the headers after get() returns
+        if export.cursor:
+            self.response.headers['X-Next-Cursor'] = export.cursor
+
+class importHandler(webapp.RequestHandler):
+    ## POST NDJSON report rows (as exported), admin only, see app.yaml
+    def post(self, title):
+        result = import_lines(title, self.request.body_file)
+        if 'stopped_at' in result:
+            ## the datastore failed, post again from line stopped_at
+            self.response.set_status(503)
+        self.response.headers.add_header('content-type', 'application/json', charset='utf-8')
+        self.response.out.write(simplejson.dumps(result))
+
 class MainHandler(webapp.RequestHandler):
     def get(self):
         self.redirect('/WaterReport/')
@@ -123,7 +446,12 @@ class MainHandler(webapp.RequestHandler):
 def main():
     application = webapp.WSGIApplication([('/WaterReport/', ThaiFloodReport),
                                         ('/', MainHandler),
+                                        (r'/(.*)/tiles/(\d+)/(\d+)/(\d+)\.(json|geojson)', tileHandler),
                                         (r'/(.*)/json', jsonHandler),
+                                        ('/admin/stats', cacheStatsHandler),
+                                        (r'/(.*)/stats', statsHandler),
+                                        (r'/(.*)/export', exportHandler),
+                                        (r'/(.*)/import', importHandler),
                                         ],
                                          debug=True)
     util.run_wsgi_app(application)
@@ -1,5 +1,37 @@
 from google.appengine.api import users  
+from google.appengine.api import memcache
 from google.appengine.ext import db
+import time
+import geo
+
+def get_generation(title):
+    ## shared counter bumped on every write to a report set, so caches
+    ## keyed on it go stale together. if memcache lost it, restart from
+    ## the clock so it never goes back to a value an old cache saw
+    key = 'generation:%s' % title
+    generation = memcache.get(key)
+    if generation is None:
+        memcache.add(key, int(time.time() * 1000))
+        generation = memcache.get(key)
+    return generation
+
+def bump_generation(title):
+    key = 'generation:%s' % title
+    generation = memcache.incr(key)
+    if generation is None:
+        memcache.add(key, int(time.time() * 1000))
+        generation = memcache.incr(key)
+    memcache.set('modified:%s' % title, time.time())
+    return generation
+
+def get_modified(title):
+    ## time of the last bump_generation(), None if memcache lost it
+    return memcache.get('modified:%s' % title)
+
+## all the map endpoints read of a report. they fetch these (with date or
+## modified, and the key) straight from the index by projection query,
+## see index.yaml, instead of loading whole entities
+MAP_FIELDS = ('lat', 'lng', 'water')
 
 class Report(db.Model):
 
@@ -15,6 +47,15 @@ class Report(db.Model):
     road = db.BooleanProperty()
     text  =db.StringProperty(multiline=True)
     date = db.DateTimeProperty(auto_now_add=True)
+    ## last write, what ?since= delta queries follow
+    modified = db.DateTimeProperty(auto_now=True)
+    ## geohash prefixes of lat/lng, for viewport queries
+    geocells = db.StringListProperty()
+
+    def set_location(self, lat, lng):
+        self.lat = lat
+        self.lng = lng
+        self.geocells = geo.cells(lat, lng)
 
     def to_dict(self):
        #return dict([(p, unicode(getattr(self, p))) for p in self.properties()])
@@ -26,3 +67,89 @@ class Report(db.Model):
         return '%i,%s\t%s. %s, %s, %s'%(self.key().id,self.title, self.name , str(self.urgent), self.text, str(self.date))
 
 
+
+
+class ReportBucket(db.Model):
+    ## the reports dated in one closed hour (buckets.py), key_name is
+    ## 'title:YYYYMMDDHH'. points is zlib'd json of the (id, date, lat, lng,
+    ## water) entries, newest first. never updated, deleted if a late
+    ## report is dated into its hour
+    title = db.StringProperty()
+    start = db.DateTimeProperty()
+    count = db.IntegerProperty(indexed=False)
+    points = db.BlobProperty()
+    updated = db.DateTimeProperty(auto_now=True)
+
+class RollupShard(db.Model):
+    ## one of rollups.NUM_SHARDS counters of the reports of one title, day
+    ## and area/city. key_name is 'title|day|area|city|shard', only ever
+    ## written in a transaction. water[i] counts the reports of level i
+    title = db.StringProperty()
+    day = db.StringProperty()
+    area = db.StringProperty()
+    city = db.StringProperty()
+    count = db.IntegerProperty(default=0, indexed=False)
+    water = db.ListProperty(int, indexed=False)
+    updated = db.DateTimeProperty(auto_now=True)
+
+class RollupMark(db.Model):
+    ## child of the RollupShard a batch's group was counted into, key_name
+    ## is the batch id. put in the same transaction as the count, so a
+    ## task delivered twice does not count its groups twice
+    created = db.DateTimeProperty(auto_now_add=True, indexed=False)
+
+class Feed(db.Model):
+    ## one entity per gov feed <item>, key_name is the feed's <id>
+    title = db.StringProperty()
+    desc = db.TextProperty()
+    road = db.BooleanProperty()
+    date = db.StringProperty()
+    lat = db.FloatProperty()
+    lng = db.FloatProperty()
+    water = db.IntegerProperty()
+    ## water level in cm as given in the title, water is its 0-8 bucket
+    level = db.FloatProperty()
+    ## place key (geocode.py) the position was looked up from, None when
+    ## the feed gave it
+    geocoded = db.StringProperty()
+    ## md5 of the raw item fields, used to skip unchanged items on reload
+    digest = db.StringProperty(indexed=False)
+    updated = db.DateTimeProperty(auto_now=True)
+
+    def to_dict(self):
+        return { 'lat':self.lat,
+                'lng':self.lng,
+                'water':self.water
+                }
+
+class Place(db.Model):
+    ## geocode cache, key_name is the normalized place string. lat/lng are
+    ## None for strings that did not resolve. edit a row to correct a place
+    lat = db.FloatProperty()
+    lng = db.FloatProperty()
+    updated = db.DateTimeProperty(auto_now=True)
+
+class FeedState(db.Model):
+    ## singleton, key_name is the feed name. what the last ingest stored
+    version = db.StringProperty()
+    items = db.IntegerProperty()
+    ## json {item id: digest} of every Feed entity currently stored
+    digests = db.BlobProperty()
+    updated = db.DateTimeProperty(auto_now=True)
+
+class FeedIngest(db.Model):
+    ## one row per cron run
+    date = db.DateTimeProperty(auto_now_add=True)
+    source = db.StringProperty()
+    version = db.StringProperty()
+    duration = db.FloatProperty()
+    unchanged_feed = db.BooleanProperty()
+    items = db.IntegerProperty(default=0)
+    added = db.IntegerProperty(default=0)
+    updated = db.IntegerProperty(default=0)
+    removed = db.IntegerProperty(default=0)
+
+    def to_dict(self):
+        return dict([(p, getattr(self, p)) for p in ('source', 'version',
+                    'duration', 'unchanged_feed', 'items', 'added',
+                    'updated', 'removed')])
@@ -0,0 +1,77 @@
+from google.appengine.api import memcache
+import calendar
+from model import get_generation
+
+## past this many reports the list is not worth a memcache round trip
+## (values are capped at 1MB), readers go to the datastore instead
+RECENT_LIMIT = 10000
+CAS_RETRIES = 3
+
+def cache_key(title):
+    return 'recent:%s' % title
+
+def timestamp(dt):
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+def to_entry(report):
+    return (report.key().id(), timestamp(report.date),
+            report.lat, report.lng, report.water)
+
+def to_dict(entry):
+    ## same shape as Report.to_dict
+    return { 'lat': entry[2],
+            'lng': entry[3],
+            'water': entry[4]
+            }
+
+def recent_reports(title, startDate, load):
+    """(id, date, lat, lng, water) of reports after startDate, newest first.
+
+    The list lives in memcache next to the generation it was built for.
+    A writer that bumped the generation by one adds its reports in
+    place (add_reports), anything else makes readers rebuild it from
+    load(), which returns the entries of the default window
+    (buckets.py). startDate must not be older than that window.
+    """
+    generation = get_generation(title)
+    cached = memcache.get(cache_key(title))
+    if cached is not None and cached[0] == generation:
+        entries = cached[1]
+    else:
+        entries = load()
+        if len(entries) <= RECENT_LIMIT:
+            memcache.set(cache_key(title), (generation, entries))
+    since = timestamp(startDate)
+    result = []
+    for e in entries:
+        if e[1] <= since:
+            break
+        result.append(e)
+    return result
+
+def add_reports(title, reports, generation, startDate=None):
+    ## write-through, after putting reports and bump_generation() ->
+    ## generation. entries older than startDate are dropped on the way
+    key = cache_key(title)
+    client = memcache.Client()
+    added = [to_entry(r) for r in reports]
+    added.sort(key=lambda e: e[1], reverse=True)
+    for i in range(CAS_RETRIES):
+        cached = client.gets(key)
+        if cached is None:
+            return
+        if cached[0] != generation - 1 or \
+                len(cached[1]) + len(added) > RECENT_LIMIT:
+            break
+        entries = cached[1]
+        if startDate is not None:
+            since = timestamp(startDate)
+            entries = [e for e in entries if e[1] > since]
+        merged = added + entries
+        if added and entries and added[-1][1] < entries[0][1]:
+            ## backdated reports (bulk import) go in date order
+            merged.sort(key=lambda e: e[1], reverse=True)
+        if client.cas(key, (generation, merged)):
+            return
+    ## someone else wrote in between, let the next reader rebuild it
+    memcache.delete(key)
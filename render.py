@@ -0,0 +1,71 @@
+from google.appengine.ext.webapp import template
+import os
+import threading
+
+## rendered pages kept per process, the cache is emptied when it is full
+MAX_FRAGMENTS = 64
+
+class TemplateCache():
+    """Compiled templates and rendered output, per process.
+
+    Each template file is compiled once (again only if its mtime changes,
+    for the dev server). render_cached() also keeps the rendered text under
+    a key the caller builds from everything the output depends on, e.g.
+    the report generation, so a data change simply makes a new key and
+    values() is only called to build the page on a miss.
+    """
+
+    def __init__(self, max_fragments=MAX_FRAGMENTS):
+        self.max_fragments = max_fragments
+        self.templates = {}
+        self.fragments = {}
+        self.lock = threading.Lock()
+        self.compiled = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime
+        cached = self.templates.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        ## the SDK keeps its own compiled copy per path and never looks at
+        ## the mtime, drop it so load() compiles the file again
+        template.template_cache.pop(path, None)
+        compiled = template.load(path)
+        self.templates[path] = (mtime, compiled)
+        self.compiled += 1
+        return compiled
+
+    def render(self, path, values):
+        return self.load(path).render(template.Context(values))
+
+    def render_cached(self, path, key, values):
+        ## values() -> template values, only called when key is not cached
+        path = os.path.abspath(path)
+        key = (path, os.stat(path).st_mtime, key)
+        body = self.fragments.get(key)
+        if body is not None:
+            self.hits += 1
+            return body
+        body = self.render(path, values())
+        self.lock.acquire()
+        try:
+            self.misses += 1
+            if len(self.fragments) >= self.max_fragments:
+                self.fragments.clear()
+            self.fragments[key] = body
+        finally:
+            self.lock.release()
+        return body
+
+    def stats(self):
+        return { 'templates': len(self.templates),
+                'compiled': self.compiled,
+                'fragments': len(self.fragments),
+                'hits': self.hits,
+                'misses': self.misses
+                }
+
+template_cache = TemplateCache()
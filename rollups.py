@@ -0,0 +1,182 @@
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+import logging
+import uuid
+import zlib
+import simplejson
+import gazetteer
+from model import RollupShard, RollupMark, bump_generation
+
+## counters per title, day and area/city. more shards, more concurrent
+## writers before transactions start to collide
+NUM_SHARDS = 8
+## other shards tried when a transaction keeps colliding
+SHARD_RETRIES = 3
+## water levels 0 .. 8, one histogram slot each
+WATER_LEVELS = 9
+
+## push queue the counting runs on, see queue.yaml and task.py
+QUEUE_NAME = 'rollups'
+TASK_URL = '/tasks/rollup_reports'
+## seconds before groups that failed are tried again
+RETRY_COUNTDOWN = 10
+
+def generation_name(title):
+    ## the counters have their own generation and modified time (model.py),
+    ## bumped when a task has counted reports in
+    return 'rollup:%s' % title
+
+def locate(lat, lng):
+    ## area for a new report: the province it is in, by nearest provincial town
+    if lat is None or lng is None:
+        return None
+    return gazetteer.nearest_province(lat, lng)
+
+def day_of(dt):
+    return dt.strftime('%Y-%m-%d')
+
+def shard_name(title, day, area, city, shard):
+    return u'|'.join([title, day, area, city, unicode(shard)])
+
+def group_reports(reports):
+    ## {(day, area, city): [count, water histogram]}
+    groups = {}
+    for r in reports:
+        key = (day_of(r.date), r.area or u'', r.city or u'')
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = [0, [0] * WATER_LEVELS]
+        group[0] += 1
+        if r.water is not None and 0 <= r.water < WATER_LEVELS:
+            group[1][r.water] += 1
+    return groups
+
+def mark_key(title, day, area, city, shard, batch):
+    return db.Key.from_path('RollupShard', shard_name(title, day, area, city, shard),
+                            'RollupMark', batch)
+
+def increment(title, day, area, city, count, water, batch):
+    """Add count and the water histogram to a shard, once per batch.
+
+    The count and a RollupMark for the batch go into the shard in one
+    transaction, and a batch that has a mark in any shard of the group is
+    not counted again. Concurrent writers of the same shard are serialized
+    by the datastore, a writer that keeps losing moves to the next shard.
+    Batches start on different shards, a batch always on the same one.
+    Returns False if every attempt failed.
+    """
+    shards = [(zlib.crc32(batch) + i) % NUM_SHARDS for i in range(NUM_SHARDS)]
+    if [m for m in db.get([mark_key(title, day, area, city, s, batch)
+                            for s in shards]) if m is not None]:
+        return True
+    def txn(shard):
+        name = shard_name(title, day, area, city, shard)
+        mark = mark_key(title, day, area, city, shard, batch)
+        if db.get(mark) is not None:
+            return
+        row = RollupShard.get_by_key_name(name)
+        if row is None:
+            row = RollupShard(key_name=name, title=title, day=day,
+                              area=area, city=city, count=0,
+                              water=[0] * WATER_LEVELS)
+        row.count += count
+        row.water = [a + b for a, b in zip(row.water, water)]
+        db.put([row, RollupMark(key=mark)])
+    for shard in shards[:SHARD_RETRIES]:
+        try:
+            db.run_in_transaction(txn, shard)
+            return True
+        except db.TransactionFailedError:
+            continue
+    return False
+
+def queue_groups(title, groups, batch, countdown=0):
+    payload = simplejson.dumps({ 'title': title, 'batch': batch, 'groups': groups })
+    try:
+        taskqueue.Queue(QUEUE_NAME).add(taskqueue.Task(
+                url=TASK_URL, payload=payload, countdown=countdown))
+    except taskqueue.Error, e:
+        ## the reports are stored already, putting them again would
+        ## count them twice
+        logging.warning('rollup of %d groups not queued: %s', len(groups), e)
+
+def add_reports(title, reports):
+    ## after putting reports: one push task counts the batch in, so the
+    ## request that stored them runs no counter transactions
+    groups = [[day, area, city, count, water] for (day, area, city), (count, water)
+              in group_reports(reports).items()]
+    if groups:
+        queue_groups(title, groups, uuid.uuid4().hex)
+
+def count_groups(title, groups, batch):
+    """Task side of add_reports: increment the counters of each group.
+
+    batch names the reports, it stays the same when the task is run again
+    or its groups are queued again, so no group is counted twice (see
+    increment). Returns the groups that could not be counted, they go
+    into a new task with a countdown.
+    """
+    failed = []
+    for group in groups:
+        day, area, city, count, water = group
+        try:
+            stored = increment(title, day, area, city, count, water, batch)
+        except db.Error, e:
+            logging.warning('rollup %s %s %s: %s', day, area, city, e)
+            stored = False
+        if not stored:
+            failed.append(group)
+    if len(failed) < len(groups):
+        bump_generation(generation_name(title))
+    return failed
+
+def summary(title, first_day):
+    """Per area totals since first_day, summed over days and shards.
+
+    Reads one row per shard, day and area/city, however many reports
+    there are. Areas come biggest first, with their cities and days.
+    """
+    areas = {}
+    query = RollupShard.all().filter('title', title).filter('day >=', first_day)
+    for shard in query:
+        area = areas.get(shard.area)
+        if area is None:
+            area = areas[shard.area] = { 'area': shard.area or None,
+                                        'count': 0,
+                                        'water': [0] * WATER_LEVELS,
+                                        'cities': {},
+                                        'days': {}
+                                        }
+        area['count'] += shard.count
+        area['water'] = [a + b for a, b in zip(area['water'], shard.water)]
+        area['days'][shard.day] = area['days'].get(shard.day, 0) + shard.count
+        if shard.city:
+            city = area['cities'].get(shard.city)
+            if city is None:
+                city = area['cities'][shard.city] = { 'city': shard.city,
+                                                     'count': 0,
+                                                     'water': [0] * WATER_LEVELS
+                                                     }
+            city['count'] += shard.count
+            city['water'] = [a + b for a, b in zip(city['water'], shard.water)]
+    result = []
+    for area in areas.values():
+        area['cities'] = sorted(area['cities'].values(),
+                                key=lambda c: c['count'], reverse=True)
+        result.append(area)
+    result.sort(key=lambda a: a['count'], reverse=True)
+    return { 'since': first_day,
+            'count': sum([a['count'] for a in result]),
+            'areas': result
+            }
+
+def get_summary(title, first_day, generation):
+    ## summary(), shared through memcache until the next write
+    key = 'rollup:%s:%s' % (title, first_day)
+    cached = memcache.get(key)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+    result = summary(title, first_day)
+    memcache.set(key, (generation, result))
+    return result
@@ -27,6 +27,9 @@ function initialize(){
     map: map,
     draggable: true
   });
+
+  // reload the reports for the visible area whenever the map settles
+  google.maps.event.addListener(map, 'idle', loadReports);
 }
 
 // Auto complete text box for address search
@@ -79,6 +82,7 @@ $(document).ready(function() {
 
 // Create Marker  
     var reportCircle;  
+    var reportCircles = [];
       function createMarker(point,name,html) {
         var marker = new google.maps.Marker(point);
         GEvent.addListener(marker, "click", function() {
@@ -110,30 +114,112 @@ $(document).ready(function() {
         // A function to parse json and call createMarker
       process_it = function(doc) {
         // === Parse the JSON document === 
-        var jsonData = eval('(' + doc + ')');
+        var jsonData = decodeColumns(doc);
         
+        // === Drop the circles of the previous viewport ===
+        for (var i=0; i<reportCircles.length; i++) {
+            reportCircles[i].setMap(null);
+        }
+        reportCircles = [];
+
         // === Plot the markers ===
         for (var i=0; i<jsonData.length; i++) {
-            var center = new google.maps.LatLng(jsonData[i].lat, jsonData[i].lng);
+            drawReport(jsonData[i]);
+        }
+      }          
+
+      // === ?format=columns: parallel arrays, lat/lng delta-encoded ===
+      // === integers in 1/scale degrees, see wire.encode_columns    ===
+      function decodeColumns(doc) {
+        var cols = window.JSON ? JSON.parse(doc) : eval('(' + doc + ')');
+        var reports = [];
+        var lat = 0, lng = 0;
+        for (var i=0; i<cols.water.length; i++) {
+            lat += cols.lat[i];
+            lng += cols.lng[i];
+            reports.push({lat: lat / cols.scale,
+                          lng: lng / cols.scale,
+                          water: cols.water[i],
+                          count: cols.count ? cols.count[i] : 1});
+        }
+        return reports;
+      }
+
+      function drawReport(report) {
+            var center = new google.maps.LatLng(report.lat, report.lng);
+            // clusters carry a count, grow them with it but keep them
+            // inside their 64px cell
+            var radius = 800;
+            if (report.count > 1) {
+                var metersPerPixel = 156543 * Math.cos(report.lat * Math.PI / 180) / Math.pow(2, map.getZoom());
+                radius = Math.max(radius, metersPerPixel * Math.min(32, 8 * Math.sqrt(report.count)));
+            }
             var circleOptions = {
                 strokeColor: 'blue',
                 strokeOpacity: 0.8,
                 strokeWeight: 3,
-                fillColor: colorPicker(jsonData[i].water),
+                fillColor: colorPicker(report.water),
                 fillOpacity: 0.4,
                 map: map,
                 center: center,
-                radius: 800
+                radius: radius
             };
         reportCircle = new google.maps.Circle(circleOptions);
-         
-        }
-      }          
+        reportCircles.push(reportCircle);
+      }
 
       
       // ================================================================
-      // === Fetch the JSON data file ====    
-      microAjax("json", process_it);
+      // === Fetch the JSON data for the visible area ====    
+      function loadReports() {
+        var bounds = map.getBounds();
+        if (bounds) {
+          microAjax("json?format=columns&bbox=" + bounds.toUrlValue() + "&zoom=" + map.getZoom(),
+                    process_it);
+        } else {
+          microAjax("json?format=columns", process_it);
+        }
+      }
+
+      // === Poll for reports written since the last poll ====
+      // zooms below this get clusters from the server, see cluster.MAX_ZOOM
+      var CLUSTER_MAX_ZOOM = 13;
+      var deltaCursor = "0";
+      var feedVersion = "";
+      var seenDeltaIds = {};
+      function pollReports() {
+        microAjax("json?since=" + encodeURIComponent(deltaCursor) + "&feed=" + feedVersion, function(doc) {
+          var delta = eval('(' + doc + ')');
+          var first = deltaCursor == "0";
+          var feedChanged = feedVersion != "" && feedVersion != delta.feed;
+          deltaCursor = delta.cursor;
+          feedVersion = delta.feed;
+
+          // the server re-sends a few seconds of overlap, skip those
+          var fresh = [];
+          for (var i=0; i<delta.reports.length; i++) {
+            if (!seenDeltaIds[delta.reports[i].id]) {
+              seenDeltaIds[delta.reports[i].id] = true;
+              fresh.push(delta.reports[i]);
+            }
+          }
+          if (!first) {
+            if (feedChanged || (fresh.length && map.getZoom() < CLUSTER_MAX_ZOOM)) {
+              // clusters or feed items changed, redraw the viewport
+              loadReports();
+            } else {
+              for (var i=0; i<fresh.length; i++) {
+                drawReport(fresh[i]);
+              }
+            }
+          }
+          if (delta.more) {
+            pollReports();
+          }
+        });
+      }
+      pollReports();
+      setInterval(pollReports, 60000);
       // ================================================================
 
 
@@ -1,18 +1,181 @@
-from google.appengine.ext import blobstore
-import urllib2
-import simplejson
-from feedparser import FeedFMSParser
+from google.appengine.ext import db
 from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
+from cStringIO import StringIO
+import hashlib
 import logging
-from model import Feed
+import time
+import simplejson
+from feedparser import FIELDS, FEED_NAME, Item, iter_fields, FileFetcher, UrlFetcher
+import feedparser
+from geocode import geocoder
+from model import Report, Feed, FeedState, FeedIngest, bump_generation
+import ingest
+import rollups
 ## Download every hour
 
+## max entities per datastore put/delete call
+BATCH_SIZE = 500
+
+FETCHERS = { 'url': UrlFetcher(),
+            'file': FileFetcher()
+            }
+
+def feed_key_name(name, id):
+    ## key names may not start with a digit
+    return '%s:%s' % (name, id)
+
+def item_digest(fields):
+    raw = u'\x00'.join([fields.get(f, u'') for f in FIELDS])
+    return hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+def to_entity(name, fields, digest):
+    item = geocoder.locate(Item(fields))
+    return Feed(key_name=feed_key_name(name, item.id),
+                title=item.title,
+                desc=item.desc,
+                road=item.road(),
+                date=item.date,
+                lat=item.lat,
+                lng=item.lng,
+                water=item.water,
+                level=item.level,
+                geocoded=item.geocoded,
+                digest=digest)
+
+def ingest_feed(fetcher, name=FEED_NAME):
+    """Fetch the feed and write only what changed since the last run.
+
+    An identical document is detected by its md5 before any parsing.
+    Otherwise items are parsed one at a time, compared by <id> against
+    the digests saved by the previous run, and changed items are put in
+    batches. Items that left the feed are deleted. Returns the
+    FeedIngest row recorded for this run.
+    """
+    start = time.time()
+    log = FeedIngest(source=fetcher.name)
+    document = fetcher.fetch()
+    log.version = hashlib.md5(document).hexdigest()
+
+    state = FeedState.get_by_key_name(name)
+    if state is None:
+        state = FeedState(key_name=name)
+
+    if state.version == log.version:
+        log.unchanged_feed = True
+        log.items = state.items or 0
+    else:
+        log.unchanged_feed = False
+        previous = {}
+        if state.digests:
+            previous = simplejson.loads(state.digests)
+        current = {}
+        batch = []
+        for fields in iter_fields(StringIO(document)):
+            id = fields.get('id')
+            if not id or id in current:
+                continue
+            digest = item_digest(fields)
+            current[id] = digest
+            old = previous.get(id)
+            if old == digest:
+                continue
+            if old is None:
+                log.added += 1
+            else:
+                log.updated += 1
+            batch.append(to_entity(name, fields, digest))
+            if len(batch) >= BATCH_SIZE:
+                db.put(batch)
+                batch = []
+        if batch:
+            db.put(batch)
+
+        gone = [db.Key.from_path('Feed', feed_key_name(name, id))
+                for id in previous if id not in current]
+        for i in range(0, len(gone), BATCH_SIZE):
+            db.delete(gone[i:i + BATCH_SIZE])
+        log.removed = len(gone)
+        log.items = len(current)
+
+        state.version = log.version
+        state.items = log.items
+        state.digests = db.Blob(simplejson.dumps(current))
+        state.put()
+        ## every instance's feed_cache reloads the rows on its next request
+        bump_generation(feedparser.generation_name(name))
+
+    log.duration = time.time() - start
+    log.put()
+    logging.info('feed %s ingested from %s in %.3fs: %s', name, fetcher.name,
+                 log.duration, log.to_dict())
+    return log
+
 class FeedReload(webapp.RequestHandler):
-        
+
     def get(self):
-        feed = FeedFMSParser()
-        final_report = feed.store_items()
-        json = simplejson.dumps(final_report)
+        fetcher = FETCHERS.get(self.request.get('source'), FETCHERS['url'])
+        log = ingest_feed(fetcher)
+        json = simplejson.dumps(log.to_dict())
         self.response.headers.add_header('content-type', 'application/json', charset='utf-8')
         self.response.out.write(json)
 
+class BackfillGeocells(webapp.RequestHandler):
+    ## fills Report.geocells for reports saved before it existed, one page
+    ## per call. call again with the returned cursor until it is null
+
+    def get(self):
+        reports = Report.all()
+        cursor = self.request.get('cursor')
+        if cursor:
+            reports.with_cursor(cursor)
+        batch = reports.fetch(BATCH_SIZE)
+        for r in batch:
+            if r.lat is not None and r.lng is not None:
+                r.set_location(r.lat, r.lng)
+        db.put(batch)
+        json = simplejson.dumps({ 'updated': len(batch),
+                                'cursor': len(batch) == BATCH_SIZE and reports.cursor() or None
+                                })
+        self.response.headers.add_header('content-type', 'application/json', charset='utf-8')
+        self.response.out.write(json)
+
+class FlushReports(webapp.RequestHandler):
+    ## drains the 'reports' pull queue (ingest.DURABILITY = 'queue') and
+    ## whatever this instance still buffers
+
+    def get(self):
+        ingest.report_queue.flush()
+        stored = 0
+        if ingest.report_queue.durability == 'queue':
+            stored = ingest.drain_queue()
+        stats = ingest.report_queue.stats()
+        stats['drained'] = stored
+        self.response.headers.add_header('content-type', 'application/json', charset='utf-8')
+        self.response.out.write(simplejson.dumps(stats))
+
+class RollupReports(webapp.RequestHandler):
+    ## push task from rollups.add_reports: counts a batch of stored
+    ## reports into the area/city counters
+
+    def post(self):
+        task = simplejson.loads(self.request.body)
+        ## tasks queued before batches had ids: their name is stable
+        ## across deliveries too
+        batch = task.get('batch') or self.request.headers['X-AppEngine-TaskName']
+        failed = rollups.count_groups(task['title'], task['groups'], batch)
+        if failed:
+            rollups.queue_groups(task['title'], failed, batch, rollups.RETRY_COUNTDOWN)
+
+def main():
+    application = webapp.WSGIApplication([('/tasks/reload_feed', FeedReload),
+                                        ('/tasks/backfill_geocells', BackfillGeocells),
+                                        ('/tasks/flush_reports', FlushReports),
+                                        ('/tasks/rollup_reports', RollupReports),
+                                        ],
+                                         debug=True)
+    util.run_wsgi_app(application)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+## stand-ins for the App Engine SDK (and its bundled django), so modules
+## that import it can be unit tested without the SDK. nothing here is
+## called by the tests: the stubs only have to survive import and class
+## definitions. with the real SDK on sys.path they are not installed.
+##
+##   python -m unittest discover -s tests
+import sys
+import types
+
+class Stub(object):
+    def __init__(self, *args, **kwargs):
+        pass
+
+class StubModule(types.ModuleType):
+    ## any attribute is a class: db.Model, db.StringProperty, webapp.RequestHandler ...
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        base = name.endswith('Error') and Exception or Stub
+        value = type(name, (base,), {})
+        setattr(self, name, value)
+        return value
+
+def install():
+    import simplejson
+    for name in ('google', 'google.appengine', 'google.appengine.api',
+                 'google.appengine.api.users', 'google.appengine.api.memcache',
+                 'google.appengine.api.urlfetch', 'google.appengine.api.taskqueue',
+                 'google.appengine.ext', 'google.appengine.ext.db',
+                 'google.appengine.ext.db.djangoforms',
+                 'google.appengine.ext.webapp', 'google.appengine.ext.webapp.util',
+                 'google.appengine.ext.webapp.template',
+                 'django', 'django.utils'):
+        module = StubModule(name)
+        module.__path__ = []
+        sys.modules[name] = module
+        parent, dot, child = name.rpartition('.')
+        if parent:
+            setattr(sys.modules[parent], child, module)
+    sys.modules['django.utils'].simplejson = simplejson
+    sys.modules['django.utils.simplejson'] = simplejson
+
+try:
+    from google.appengine.ext import db
+except ImportError:
+    install()
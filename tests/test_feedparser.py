@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from xml.etree import cElementTree
+import gaestubs
+import feedparser
+
+FEED = os.path.join(os.path.dirname(feedparser.__file__), 'feed.xml')
+
+## title -> level in cm, one per format seen in (or expected from) the feed
+TITLES = [(u'น้ำท่วมทางหลวง สพ.6098 จ.สุพรรณบุรี สูง 80 ซม. (ผ่านไม่ได้)', 80),
+          (u'น้ำท่วมทางหลวง 1 จ.ชัยนาท สูง 12.5 ซม. (ผ่านได้)', 12.5),
+          (u'น้ำท่วม สูง ๘๐ ซม.', 80),
+          (u'น้ำท่วม สูง 1.2 ม.', 120),
+          (u'น้ำท่วม สูง 1.5 เมตร', 150),
+          (u'น้ำท่วม สูง 30-50 ซม.', 50),
+          (u'น้ำท่วม สูงประมาณ 20 ถึง 40 ซ.ม.', 40),
+          (u'น้ำท่วม สูง 40', 40),
+          (u'flooded 60 cm', 60),
+          (u'น้ำท่วมทางหลวง สพ.6098', None),
+          (u'ระดับน้ำ 0.5 m', 50),
+          (u'no level', None),
+          (u'กม.ที่ 3.800 น้ำสูง 25ซม.', 25),
+          ## ม. (metre) inside a date, ม.ค. is January
+          (u'น้ำท่วม ถนน 12 ม.ค. 2555', None),
+          (u'น้ำท่วม สูง 12 ม.ค. 2555', 12)
+          ]
+
+class WaterLevelTest(unittest.TestCase):
+
+    def test_titles(self):
+        for title, cm in TITLES:
+            self.assertEqual(feedparser.water_cm(title), cm, title.encode('utf-8'))
+
+    def test_buckets(self):
+        self.assertEqual(feedparser.water_bucket(None), 0)
+        self.assertEqual(feedparser.water_bucket(14.9), 0)
+        self.assertEqual(feedparser.water_bucket(15), 1)
+        self.assertEqual(feedparser.water_bucket(1200), feedparser.WATER_MAX)
+
+    def test_feed_titles(self):
+        ## every title in the bundled feed that gives a height (สูง) parses,
+        ## to a sane level
+        titles = [e.text for e in cElementTree.parse(FEED).iter()
+                  if e.tag == 'title' and e.text]
+        self.assertTrue(len(titles) > 100)
+        for title in titles:
+            cm = feedparser.water_cm(title)
+            if u'สูง' in title:
+                self.assertNotEqual(cm, None, title.encode('utf-8'))
+            if cm is not None:
+                self.assertTrue(0 <= cm <= 500, title.encode('utf-8'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import random
+import unittest
+import gaestubs
+import localsearch
+from localsearch import MercatorProjection
+
+CASES = 20000
+
+def random_bounds(rng):
+    ## spans from 1e-6 to 300 degrees, some inverted or degenerate
+    lat = rng.uniform(-85, 85)
+    lng = rng.uniform(-180, 180)
+    span = 10 ** rng.uniform(-6, 2.5)
+    kind = rng.random()
+    if kind < 0.05:
+        return [[lat, lng], [lat, lng]]
+    if kind < 0.15:
+        ## northeast below / west of southwest
+        return [[lat, lng], [lat - span / 2, lng - span]]
+    ne_lng = lng + span
+    if ne_lng > 180:
+        ## across the antimeridian
+        ne_lng -= 360
+    return [[lat, lng], [min(lat + span / 2, 85), ne_lng]]
+
+def random_size(rng):
+    return [rng.choice([0, 1, rng.randint(0, 2000)]), rng.randint(0, 2000)]
+
+class BoundsZoomLevelTest(unittest.TestCase):
+    ## CalculateBoundsZoomLevel(s) against the zoom by zoom search
+
+    def setUp(self):
+        self.numpy = localsearch.numpy
+        self.projection = MercatorProjection(18)
+        rng = random.Random(7)
+        self.cases = [(random_bounds(rng), random_size(rng)) for i in range(CASES)]
+
+    def tearDown(self):
+        localsearch.numpy = self.numpy
+
+    def test_direct(self):
+        p = self.projection
+        for bounds, size in self.cases:
+            self.assertEqual(p.CalculateBoundsZoomLevel(bounds, size),
+                             p.CalculateBoundsZoomLevelBySearch(bounds, size),
+                             (bounds, size))
+
+    def check_batch(self):
+        p = self.projection
+        bounds = [b for b, s in self.cases]
+        sizes = [s for b, s in self.cases]
+        expected = [p.CalculateBoundsZoomLevelBySearch(b, s) for b, s in self.cases]
+        self.assertEqual(p.CalculateBoundsZoomLevels(bounds, sizes), expected)
+
+    def test_batch(self):
+        self.check_batch()
+
+    def test_batch_without_numpy(self):
+        localsearch.numpy = None
+        self.check_batch()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import hashlib
+import threading
+import simplejson
+import cluster
+from cluster import VersionCache
+from localsearch import MERCATOR_PROJECTION
+
+TILE_SIZE = 256
+## tile bodies kept per TileSet, the cache is emptied when it is full
+MAX_TILE_BODIES = 4096
+## tiles exist for zooms 0 .. MAX_ZOOM-1
+MAX_ZOOM = len(MERCATOR_PROJECTION.pixel_range)
+
+projection = MERCATOR_PROJECTION
+
+def geojson(records):
+    return { 'type': 'FeatureCollection',
+            'features': [{ 'type': 'Feature',
+                          'geometry': { 'type': 'Point',
+                                       'coordinates': [r['lng'], r['lat']] },
+                          'properties': dict([(k, v) for k, v in r.items()
+                                              if k not in ('lat', 'lng')])
+                          } for r in records]
+            }
+
+ENCODERS = { 'json': lambda records: records,
+            'geojson': geojson
+            }
+
+class TileSet():
+    """XYZ tiles of one version of the map data.
+
+    Below cluster.MAX_ZOOM a tile holds the clusters whose centroid falls
+    in it (cluster cells are 64px and tiles 256px, so cells never straddle
+    tiles), above it the raw points. A zoom level is bucketed on its first
+    request and every tile body is encoded once, with its ETag.
+    """
+
+    def __init__(self, version, clusters):
+        self.version = version
+        self.clusters = clusters
+        self.zooms = {}
+        self.bodies = {}
+        self.lock = threading.Lock()
+
+    def records(self, zoom):
+        if zoom < cluster.MAX_ZOOM:
+            return self.clusters.levels[zoom]
+        lats, lngs, waters = self.clusters.points
+        return [{ 'lat': lat, 'lng': lng, 'water': water }
+                for lat, lng, water in zip(lats, lngs, waters)]
+
+    def bucket(self, zoom):
+        tiles = self.zooms.get(zoom)
+        if tiles is not None:
+            return tiles
+        self.lock.acquire()
+        try:
+            tiles = self.zooms.get(zoom)
+            if tiles is None:
+                records = self.records(zoom)
+                xs, ys = projection.FromLatLngsToPixels(
+                        [r['lat'] for r in records],
+                        [r['lng'] for r in records], zoom)
+                last = (1 << zoom) - 1
+                tiles = {}
+                for r, x, y in zip(records, list(xs), list(ys)):
+                    key = (min(int(x) // TILE_SIZE, last),
+                           min(int(y) // TILE_SIZE, last))
+                    tiles.setdefault(key, []).append(r)
+                self.zooms[zoom] = tiles
+            return tiles
+        finally:
+            self.lock.release()
+
+    def tile(self, zoom, x, y, format='json'):
+        ## (body, etag) of one tile. empty tiles, most of them at close
+        ## zooms, share one body per format and are not kept
+        records = self.bucket(zoom).get((x, y))
+        if not records:
+            return EMPTY_TILES[format]
+        key = (zoom, x, y, format)
+        cached = self.bodies.get(key)
+        if cached is None:
+            cached = encode_tile(records, format)
+            self.lock.acquire()
+            try:
+                if len(self.bodies) >= MAX_TILE_BODIES:
+                    self.bodies.clear()
+                self.bodies[key] = cached
+            finally:
+                self.lock.release()
+        return cached
+
+def encode_tile(records, format):
+    body = simplejson.dumps(ENCODERS[format](records))
+    return body, '"%s"' % hashlib.md5(body).hexdigest()
+
+## format -> (body, etag) of a tile with nothing in it
+EMPTY_TILES = dict([(format, encode_tile([], format)) for format in ENCODERS])
+tile_cache = VersionCache()
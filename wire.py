@@ -0,0 +1,75 @@
+import array
+import struct
+import sys
+import simplejson
+
+## lat / lng go out as integers in units of 1e-5 degrees (about 1m)
+SCALE = 100000
+
+def fixed(value):
+    return int(round(value * SCALE))
+
+def columns(records):
+    ## -> (lats, lngs, waters, counts), counts is None unless they are clusters
+    lats, lngs, waters, counts = [], [], [], []
+    for r in records:
+        lats.append(fixed(r['lat']))
+        lngs.append(fixed(r['lng']))
+        waters.append(r['water'] or 0)
+        counts.append(r.get('count', 1))
+    if not [c for c in counts if c != 1]:
+        counts = None
+    return lats, lngs, waters, counts
+
+def deltas(values):
+    ## [a, b, c] -> [a, b-a, c-b]
+    result = []
+    last = 0
+    for v in values:
+        result.append(v - last)
+        last = v
+    return result
+
+def encode_columns(records):
+    """Parallel arrays instead of one object per point.
+
+    lat / lng are delta-encoded fixed-point integers, the client keeps a
+    running sum and divides by scale. count is only there for clusters.
+    """
+    lats, lngs, waters, counts = columns(records)
+    body = { 'scale': SCALE,
+            'lat': deltas(lats),
+            'lng': deltas(lngs),
+            'water': waters
+            }
+    if counts is not None:
+        body['count'] = counts
+    return simplejson.dumps(body, separators=(',', ':'))
+
+def packed(typecode, values):
+    a = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tostring()
+
+def encode_binary(records):
+    """Little-endian blob, laid out so each column is a typed array view.
+
+      uint32 n, uint32 flags (1: counts present)
+      int32 lat[n], int32 lng[n] (1e-5 degrees, not delta-encoded)
+      uint32 count[n] if flags & 1
+      uint8 water[n]
+    """
+    lats, lngs, waters, counts = columns(records)
+    parts = [struct.pack('<II', len(lats), counts is not None and 1 or 0),
+             packed('i', lats),
+             packed('i', lngs)]
+    if counts is not None:
+        parts.append(packed('I', counts))
+    parts.append(packed('B', [min(max(w, 0), 255) for w in waters]))
+    return ''.join(parts)
+
+## ?format= -> (encoder, content type)
+FORMATS = { 'columns': (encode_columns, 'application/json; charset=utf-8'),
+           'binary': (encode_binary, 'application/octet-stream')
+           }